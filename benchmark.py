@@ -0,0 +1,322 @@
+"""Benchmarks de temporizador.py sobre la nube Meross simulada (fake_meross.py).
+
+No necesita credenciales ni dispositivos. Mide:
+
+    timer_throughput  peticiones POST /timer por segundo y su latencia
+    pending_cost      memoria e hilos que cuestan N temporizadores pendientes
+    firing_jitter     retraso de disparo del planificador con 10k temporizadores
+    end_to_end        latencia de un trabajo desde que vence hasta su resultado
+                      y error de disparo del comando respecto a su hora
+
+Uso:
+    python benchmark.py
+    python benchmark.py --only firing_jitter --timers 20000
+    python benchmark.py --output nuevo.json --compare benchmark-results.json
+
+Los resultados se guardan en JSON (--output) para compararlos entre versiones.
+"""
+
+import argparse
+import concurrent.futures
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+BENCHMARKS = ("timer_throughput", "pending_cost", "firing_jitter", "end_to_end")
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize_ms(samples):
+    """Resumen de una lista de duraciones en segundos, en milisegundos"""
+    return {
+        "p50_ms": round(percentile(samples, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(samples, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(samples, 0.99) * 1000, 3),
+        "max_ms": round(max(samples) * 1000, 3),
+        "mean_ms": round(sum(samples) / len(samples) * 1000, 3)
+    }
+
+
+def load_app(workdir, log_path):
+    """Importa temporizador.py contra la nube simulada, con diario y lock en workdir"""
+    os.environ["MEROSS_FAKE_CLOUD"] = "1"
+    os.environ.setdefault("MEROSS_EMAIL", "bench@example.com")
+    os.environ.setdefault("MEROSS_PASSWORD", "bench")
+    os.environ.pop("MEROSS_API_KEY", None)
+    os.environ.setdefault("JOB_JOURNAL_PATH", os.path.join(workdir, "jobs.journal"))
+    os.environ.setdefault("SCHEDULER_LOCK_PATH", os.path.join(workdir, "scheduler.lock"))
+    # Los límites de la nube real no son lo que se mide aquí
+    os.environ.setdefault("COMMAND_RATE_PER_SECOND", "10000")
+    os.environ.setdefault("COMMAND_BURST", "10000")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    import temporizador
+    temporizador.log_writer.stream = open(log_path, "w", encoding="utf-8")
+    return temporizador
+
+
+def bench_timer_throughput(t, args):
+    """POST /timer desde varios hilos, con el diario en disco como en producción"""
+    requests_total = args.requests
+    latencies = []
+    job_ids = []
+    lock = threading.Lock()
+
+    def worker(indexes):
+        client = t.app.test_client()
+        for i in indexes:
+            started = time.perf_counter()
+            response = client.post("/timer", json={"device_name": f"bench{i}", "action": "off", "minutes": 60})
+            elapsed = time.perf_counter() - started
+            body = response.get_json()
+            with lock:
+                latencies.append(elapsed)
+                if response.status_code == 200:
+                    job_ids.append(body["job_id"])
+
+    chunks = [range(i, requests_total, args.http_threads) for i in range(args.http_threads)]
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(args.http_threads) as pool:
+        list(pool.map(worker, chunks))
+    wall = time.perf_counter() - started
+
+    for job_id in job_ids:
+        t.cancel_job_entry(job_id)
+    return {
+        "requests": requests_total,
+        "http_threads": args.http_threads,
+        "ok": len(job_ids),
+        "requests_per_second": round(requests_total / wall, 1),
+        **summarize_ms(latencies)
+    }
+
+
+def bench_pending_cost(t, args):
+    """Memoria de Python e hilos añadidos por N temporizadores esperando"""
+    count = args.timers
+    gc.collect()
+    threads_before = threading.active_count()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+
+    def schedule(i):
+        t.schedule_delayed_task(os.getenv("MEROSS_EMAIL"), os.getenv("MEROSS_PASSWORD"),
+                                f"pending{i}", "off", 60, f"pending_{i}")
+
+    # Muchos hilos para que el fsync agrupado del diario no domine la medida
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(64) as pool:
+        list(pool.map(schedule, range(count)))
+    schedule_seconds = time.perf_counter() - started
+
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    threads_after = threading.active_count()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    pending = t.scheduler.pending_count()
+
+    for i in range(count):
+        t.cancel_job_entry(f"pending_{i}")
+    return {
+        "timers": count,
+        "pending_in_scheduler": pending,
+        "schedule_seconds": round(schedule_seconds, 3),
+        "python_bytes_total": allocated,
+        "python_bytes_per_timer": round(allocated / count, 1),
+        "threads_added": threads_after - threads_before
+    }
+
+
+def bench_firing_jitter(t, args):
+    """Retraso entre el vencimiento y la entrega al despacho, sin agrupar (ventana 0)"""
+    count = args.jitter_timers
+    lateness = []
+    batches = []
+    done = threading.Event()
+
+    def dispatch(batch):
+        fired = time.monotonic()
+        batches.append(len(batch))
+        for _, payload in batch:
+            lateness.append(fired - payload["due"])
+        if len(lateness) >= count:
+            done.set()
+
+    scheduler = t.TimerScheduler(dispatch, coalesce_window=0)
+    lead = 1.0
+    for i in range(count):
+        payload = {}
+        payload["due"] = scheduler.schedule(f"jitter_{i}", lead + args.spread * i / count, payload)
+    done.wait(lead + args.spread + 30)
+
+    return {
+        "timers": count,
+        "spread_seconds": args.spread,
+        "fired": len(lateness),
+        "dispatch_calls": len(batches),
+        **summarize_ms(lateness)
+    }
+
+
+def bench_end_to_end(t, args):
+    """Trabajos con vencimiento inmediato hasta su resultado, con la sesión ya caliente"""
+    import fake_meross
+
+    fake_meross.config.latency = args.latency
+    fake_meross.config.failure_rate = args.failure_rate
+    email = os.getenv("MEROSS_EMAIL")
+    password = os.getenv("MEROSS_PASSWORD")
+
+    finished = {}
+    all_done = threading.Event()
+    original_finish = t.finish_scheduled_task
+    expected = set()
+
+    def finish(job_id, result):
+        finished[job_id] = (time.time(), result.get("status"), result.get("firing_error_ms"))
+        original_finish(job_id, result)
+        if expected and expected <= finished.keys():
+            all_done.set()
+
+    t.finish_scheduled_task = finish
+    try:
+        # Calentar: login, gestor y descubrimiento fuera de la medida
+        t.get_meross_session(email, password).run(
+            t.get_meross_session(email, password).async_refresh_devices("bench"), timeout=30)
+
+        phases_before = phase_totals(t)
+        devices = fake_meross.config.devices
+        due = {}
+        for i in range(args.jobs):
+            job_id = f"e2e_{i}"
+            expected.add(job_id)
+            due[job_id] = t.schedule_delayed_task(
+                email, password, devices[i % len(devices)], "off" if i % 2 else "on", 0, job_id
+            ).timestamp()
+        all_done.wait(60 + args.jobs * (args.latency * 10))
+    finally:
+        t.finish_scheduled_task = original_finish
+
+    samples = [finished[job_id][0] - due[job_id] for job_id in due if job_id in finished]
+    firing_errors = [finished[job_id][2] / 1000 for job_id in due
+                     if job_id in finished and finished[job_id][2] is not None]
+    phases = {}
+    for phase, (count, total) in phase_totals(t).items():
+        count_before, total_before = phases_before.get(phase, (0, 0.0))
+        if count > count_before:
+            phases[f"{phase}_mean_ms"] = round((total - total_before) / (count - count_before) * 1000, 3)
+    return {
+        "jobs": args.jobs,
+        "completed": len(samples),
+        "succeeded": sum(1 for job_id in due if finished.get(job_id, (0, None))[1] == "success"),
+        "cloud_latency_ms": args.latency * 1000,
+        **(summarize_ms(samples) if samples else {}),
+        "firing_error": summarize_ms(firing_errors) if firing_errors else {},
+        "phases": phases
+    }
+
+
+def phase_totals(t):
+    """(cuenta, suma) por fase del histograma de /metrics"""
+    return {phase: (sum(counts), total) for phase, (counts, total) in list(t.PHASE_SECONDS._series.items())}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+def flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(baseline_path, current):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    old = flatten(baseline["results"])
+    new = flatten(current["results"])
+    print(f"\n=== Comparación con {baseline_path} ({baseline['meta'].get('git_revision')}) ===")
+    for name in sorted(old.keys() & new.keys()):
+        before, after = old[name], new[name]
+        delta = f"{(after - before) / before * 100:+.1f}%" if before else "n/a"
+        print(f"{name:50} {before:>14} {after:>14} {delta:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks de temporizador.py con la nube simulada")
+    parser.add_argument("--only", action="append", choices=BENCHMARKS, help="benchmark a ejecutar (repetible)")
+    parser.add_argument("--requests", type=int, default=2000, help="peticiones POST /timer")
+    parser.add_argument("--http-threads", type=int, default=8, help="hilos cliente concurrentes")
+    parser.add_argument("--timers", type=int, default=10000, help="temporizadores pendientes para pending_cost")
+    parser.add_argument("--jitter-timers", type=int, default=10000, help="temporizadores para firing_jitter")
+    parser.add_argument("--spread", type=float, default=5.0, help="segundos entre el primer y el último disparo")
+    parser.add_argument("--jobs", type=int, default=200, help="trabajos para end_to_end")
+    parser.add_argument("--latency", type=float, default=0.05, help="latencia simulada de la nube (segundos)")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="probabilidad de fallo simulado")
+    parser.add_argument("--output", default="benchmark-results.json", help="fichero de resultados")
+    parser.add_argument("--compare", help="resultados anteriores con los que comparar")
+    parser.add_argument("--log", default=os.devnull, help="fichero para los logs del servicio")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="temporizador-bench-")
+    t = load_app(workdir, args.log)
+
+    selected = args.only or BENCHMARKS
+    results = {}
+    for name in BENCHMARKS:
+        if name not in selected:
+            continue
+        print(f"▶️  {name}...", flush=True)
+        started = time.perf_counter()
+        results[name] = globals()[f"bench_{name}"](t, args)
+        print(f"   {json.dumps(results[name], ensure_ascii=False)} ({time.perf_counter() - started:.1f}s)", flush=True)
+
+    output = {
+        "meta": {
+            "git_revision": git_revision(),
+            "timestamp": datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "args": vars(args)
+        },
+        "results": results
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(output, f, indent=2, ensure_ascii=False)
+    print(f"💾 Resultados en {args.output}")
+
+    if args.compare:
+        compare(args.compare, output)
+    t.log_writer.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""Nube Meross simulada para benchmarks y pruebas locales sin credenciales.
+
+Sustituye a MerossHttpClient y MerossManager con la misma interfaz que usa
+temporizador.py. Se activa con MEROSS_FAKE_CLOUD=1 y se ajusta con:
+
+    FAKE_MEROSS_DEVICES             nombres de los enchufes (coma)
+    FAKE_MEROSS_LATENCY             latencia de cada llamada a la nube (segundos)
+    FAKE_MEROSS_JITTER              variación aleatoria sobre la latencia (segundos)
+    FAKE_MEROSS_LOGIN_LATENCY       latencia del login (segundos)
+    FAKE_MEROSS_FAILURE_RATE        probabilidad de fallo de cada llamada (0-1)
+    FAKE_MEROSS_LOGIN_FAILURE_RATE  probabilidad de fallo del login (0-1)
+    FAKE_MEROSS_PUSH                1 = los cambios se notifican por push (MQTT)
+    FAKE_MEROSS_PUSH_DELAY          retraso de la notificación push (segundos)
+    FAKE_MEROSS_LAN                 1 = los enchufes informan de una IP local (lan_ip)
+    FAKE_MEROSS_LAN_LATENCY         latencia de cada petición LAN (segundos)
+    FAKE_MEROSS_LAN_FAILURE_RATE    probabilidad de fallo de cada petición LAN (0-1)
+
+Los valores también se pueden cambiar en caliente a través de `config`.
+
+Como el manager de meross-iot, con default_transport_mode en LAN_HTTP_FIRST
+las llamadas de un enchufe con lan_ip van primero por la LAN y, si fallan,
+por la nube; los fallos de la nube no afectan a la LAN.
+"""
+
+import asyncio
+import os
+import random
+import uuid as uuid_lib
+
+from meross_iot.manager import TransportMode
+from meross_iot.model.enums import OnlineStatus
+
+
+class FakeCloudError(Exception):
+    """Fallo inyectado: se trata como cualquier error transitorio de la nube"""
+
+
+class FakeCloudConfig:
+    def __init__(self):
+        self.devices = [name.strip() for name in
+                        os.getenv('FAKE_MEROSS_DEVICES', 'KodiPlex,HTPC').split(',') if name.strip()]
+        self.latency = float(os.getenv('FAKE_MEROSS_LATENCY', 0.05))
+        self.jitter = float(os.getenv('FAKE_MEROSS_JITTER', 0.01))
+        self.login_latency = float(os.getenv('FAKE_MEROSS_LOGIN_LATENCY', 0.3))
+        self.failure_rate = float(os.getenv('FAKE_MEROSS_FAILURE_RATE', 0))
+        self.login_failure_rate = float(os.getenv('FAKE_MEROSS_LOGIN_FAILURE_RATE', 0))
+        self.push = os.getenv('FAKE_MEROSS_PUSH', '1').lower() in ('1', 'true', 'yes')
+        self.push_delay = float(os.getenv('FAKE_MEROSS_PUSH_DELAY', 0.05))
+        self.lan = os.getenv('FAKE_MEROSS_LAN', '0').lower() in ('1', 'true', 'yes')
+        self.lan_latency = float(os.getenv('FAKE_MEROSS_LAN_LATENCY', 0.005))
+        self.lan_failure_rate = float(os.getenv('FAKE_MEROSS_LAN_FAILURE_RATE', 0))
+        # Contadores para los benchmarks
+        self.logins = 0
+        self.calls = 0
+        self.failures = 0
+        self.lan_calls = 0
+
+    async def cloud_call(self, latency=None, failure_rate=None):
+        """Simula una llamada a la nube: espera la latencia y falla con la probabilidad dada"""
+        self.calls += 1
+        delay = self.latency if latency is None else latency
+        await asyncio.sleep(max(0, delay + random.uniform(-self.jitter, self.jitter)))
+        if random.random() < (self.failure_rate if failure_rate is None else failure_rate):
+            self.failures += 1
+            raise FakeCloudError("Fallo simulado de la nube Meross")
+
+    async def lan_call(self):
+        """Simula una petición HTTP local al enchufe"""
+        self.lan_calls += 1
+        await asyncio.sleep(max(0, self.lan_latency))
+        if random.random() < self.lan_failure_rate:
+            raise FakeCloudError("Fallo simulado de la LAN")
+
+config = FakeCloudConfig()
+
+
+class FakePushNotification:
+    def __init__(self, device_uuid, raw_data):
+        self.originating_device_uuid = device_uuid
+        self.raw_data = raw_data
+
+
+class FakeDevice:
+    """Enchufe simulado con un único canal on/off"""
+
+    def __init__(self, name, manager):
+        self.name = name
+        self.uuid = uuid_lib.uuid5(uuid_lib.NAMESPACE_DNS, f"fake-meross-{name}").hex
+        self.type = "mss310"
+        self.online_status = OnlineStatus.ONLINE
+        self._manager = manager
+        self._is_on = True
+        self.lan_ip = "127.0.0.1" if config.lan else None
+
+    def is_on(self, channel=0):
+        return self._is_on
+
+    async def async_update(self, *args, **kwargs):
+        await self._manager.call(self)
+
+    async def async_turn_on(self, *args, **kwargs):
+        await self._set_state(True)
+
+    async def async_turn_off(self, *args, **kwargs):
+        await self._set_state(False)
+
+    async def _set_state(self, is_on):
+        await self._manager.call(self)
+        self._is_on = is_on
+        if config.push:
+            asyncio.ensure_future(self._manager.notify(self, is_on))
+
+
+class FakeMerossHttpClient:
+    @classmethod
+    async def async_from_user_password(cls, api_base_url, email, password, **kwargs):
+        await config.cloud_call(config.login_latency, config.login_failure_rate)
+        config.logins += 1
+        return cls()
+
+    async def async_logout(self):
+        await config.cloud_call(failure_rate=0)
+
+
+class FakeMerossManager:
+    def __init__(self, http_client, **kwargs):
+        self.http_client = http_client
+        self._handlers = []
+        self._devices = []
+        self.default_transport_mode = TransportMode.MQTT_ONLY
+
+    def register_push_notification_handler_coroutine(self, handler):
+        self._handlers.append(handler)
+
+    async def async_init(self):
+        await config.cloud_call()
+
+    async def call(self, device):
+        """Una llamada al enchufe: por la LAN si el modo y la IP lo permiten, si no por la nube"""
+        if self.default_transport_mode == TransportMode.LAN_HTTP_FIRST and device.lan_ip is not None:
+            try:
+                return await config.lan_call()
+            except FakeCloudError:
+                pass
+        await config.cloud_call()
+
+    async def async_device_discovery(self, *args, **kwargs):
+        await config.cloud_call()
+        known = {device.name for device in self._devices}
+        self._devices.extend(FakeDevice(name, self) for name in config.devices if name not in known)
+        return self._devices
+
+    def find_devices(self, device_name=None, **kwargs):
+        return [device for device in self._devices if device_name in (None, device.name)]
+
+    async def notify(self, device, is_on):
+        """Entrega a los manejadores la notificación push de un cambio de estado"""
+        await asyncio.sleep(config.push_delay)
+        notification = FakePushNotification(device.uuid, {"togglex": {"channel": 0, "onoff": int(is_on)}})
+        for handler in self._handlers:
+            await handler(notification, [device], self)
+
+    def close(self):
+        pass
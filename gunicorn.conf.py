@@ -0,0 +1,24 @@
+# Configuración de gunicorn para producción (Render).
+# En local se puede seguir usando: python temporizador.py
+#
+# Cada worker atiende varias peticiones a la vez con hilos (gthread); las
+# llamadas a Meross se envían al loop de la sesión compartida del worker.
+# Solo un worker (el que obtiene SCHEDULER_LOCK_PATH) ejecuta el planificador;
+# los demás escriben sus trabajos en el diario compartido y el líder los recoge.
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+graceful_timeout = 30
+keepalive = 5
+
+# Los hilos del planificador y de la sesión Meross se crean al importar la app:
+# sin preload cada worker los crea después del fork. El master abre el puerto
+# antes de cargar la app, y la app difiere lo pesado al hilo de calentamiento
+preload_app = False
+
+accesslog = '-'
+errorlog = '-'
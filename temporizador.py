@@ -1,159 +1,2750 @@
 import asyncio
+import atexit
+import bisect
+import collections
+import concurrent.futures
+import heapq
+import importlib
+import itertools
+import json
 import os
+import queue
+import random
+import re
+import sys
 import threading
 import time
+import uuid
 from datetime import datetime, timedelta
+
+# Referencia del arranque en frío: todo lo que sigue cuenta como arranque del worker
+STARTUP_STARTED = time.perf_counter()
+
+# Solo lo necesario para responder a / y /status; aiohttp, el cliente y el
+# manager de meross-iot y APScheduler se importan al usarse (ver ARRANQUE)
 import pytz
 from flask import Flask, request, jsonify
-from meross_iot.http_api import MerossHttpClient
-from meross_iot.manager import MerossManager
+from meross_iot.model.exception import UnconnectedError
+from meross_iot.model.http.exception import BadLoginException, TokenExpiredException, UnauthorizedException
+
+IMPORTS_DONE = time.perf_counter()
+
+# Nube simulada (fake_meross.py) para benchmarks y pruebas sin credenciales
+MEROSS_FAKE_CLOUD = os.getenv('MEROSS_FAKE_CLOUD', '').lower() in ('1', 'true', 'yes')
+
+try:
+    import fcntl
+except ImportError:  # Windows: un solo proceso, sin locks entre workers
+    fcntl = None
+
+app = Flask(__name__)
+
+# Configurar timezone de España
+SPAIN_TZ = pytz.timezone('Europe/Madrid')
+
+# ===== LOGS =====
+
+# Formato de salida: json (un registro estructurado por línea) o text (legible)
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+# Máximo de registros por escritura
+LOG_BATCH_SIZE = int(os.getenv('LOG_BATCH_SIZE', 500))
+
+class LogWriter:
+    """Escritor de logs en segundo plano.
+
+    log_message() solo encola un registro; un hilo los formatea y los escribe
+    en stdout por lotes, con una única escritura y un flush por lote. La marca
+    de tiempo formateada se reutiliza mientras no cambie el segundo.
+    """
+
+    def __init__(self, fmt=LOG_FORMAT, batch_size=LOG_BATCH_SIZE):
+        self.fmt = fmt
+        # None = sys.stdout; los benchmarks lo redirigen para no medir la consola
+        self.stream = None
+        self.batch_size = batch_size
+        self._queue = queue.SimpleQueue()
+        self._ts_second = None
+        self._ts_text = ""
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def emit(self, record):
+        self._queue.put(record)
+
+    def flush(self, timeout=2.0):
+        """Espera a que se escriba todo lo encolado hasta ahora"""
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def _timestamp(self, epoch):
+        second = int(epoch)
+        if second != self._ts_second:
+            self._ts_second = second
+            self._ts_text = datetime.fromtimestamp(second, SPAIN_TZ).strftime("%Y-%m-%d %H:%M:%S %Z")
+        return self._ts_text
+
+    def _format(self, record):
+        timestamp = self._timestamp(record["t"])
+        if self.fmt != 'json':
+            return f"[{timestamp}] {record['msg']}\n"
+        record["ts"] = timestamp
+        return json.dumps(record, ensure_ascii=False, default=str) + "\n"
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            waiters = [item for item in batch if isinstance(item, threading.Event)]
+            lines = [self._format(item) for item in batch if not isinstance(item, threading.Event)]
+            try:
+                if lines:
+                    stream = self.stream or sys.stdout
+                    stream.write("".join(lines))
+                    stream.flush()
+            except Exception:
+                pass
+            for done in waiters:
+                done.set()
+
+log_writer = LogWriter()
+atexit.register(log_writer.flush)
+
+def log_message(message, **fields):
+    """Encola un registro de log; fields añade campos estructurados (job_id, device, phase, duration_ms...)"""
+    fields["t"] = time.time()
+    fields["msg"] = message
+    log_writer.emit(fields)
+
+# ===== MÉTRICAS =====
+
+class Histogram:
+    """Histograma acumulativo al estilo Prometheus, con una serie por etiquetas"""
+
+    def __init__(self, name, help_text, buckets, label="phase"):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self.label = label
+        self._series = {}        # etiqueta -> [cuentas por cubo..., +Inf], suma
+        self._lock = threading.Lock()
+
+    def observe(self, value, label_value=""):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: (list(counts), total) for key, (counts, total) in self._series.items()}
+        for label_value, (counts, total) in sorted(series.items()):
+            labels = f'{self.label}="{label_value}",' if label_value else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append(f'{self.name}_bucket{{{labels}le="{le}"}} {cumulative}')
+            suffix = f"{{{labels.rstrip(',')}}}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {total}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+class Counter:
+    """Contador monótono con una serie por valor de etiqueta"""
+
+    def __init__(self, name, help_text, label=None):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        # Sin etiqueta la serie existe desde el principio (valor 0)
+        self._values = {} if label else {"": 0}
+        self._lock = threading.Lock()
+
+    def inc(self, label_value="", amount=1):
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_value, value in values:
+            labels = f'{{{self.label}="{label_value}"}}' if self.label else ""
+            lines.append(f"{self.name}{labels} {value}")
+        return lines
+
+class Gauge:
+    """Valor instantáneo calculado al servir /metrics (número o dict etiqueta -> número)"""
+
+    def __init__(self, name, help_text, read, label=None):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self._read = read
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        value = self._read()
+        if isinstance(value, dict):
+            for label_value, item in sorted(value.items()):
+                lines.append(f'{self.name}{{{self.label}="{label_value}"}} {item}')
+        else:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+class MetricsRegistry:
+    """Métricas de este proceso; /metrics las sirve en formato de texto de Prometheus.
+
+    Con varios workers cada uno expone las suyas: los trabajos solo se
+    ejecutan en el líder, así que sus fases y retrasos se ven en él.
+    """
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                log_message(f"⚠️ Error generando métrica {metric.name}: {str(e)}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+PHASE_SECONDS = metrics.register(Histogram(
+    "meross_timer_phase_duration_seconds",
+    "Duración de cada fase de la ejecución de un trabajo",
+    (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+))
+# Se mide en fire_job para todos los trabajos, aplazados incluidos. Cada uno
+# espera a su hora aunque se agrupe o se prepare antes; los cubos negativos
+# recogen los adelantos por saltos del reloj de pared
+LATENESS_SECONDS = metrics.register(Histogram(
+    "meross_timer_schedule_lateness_seconds",
+    "Instante real de disparo menos execution_time",
+    (-1, -0.5, -0.1, 0, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300),
+    label=None
+))
+RETRIES = metrics.register(Counter(
+    "meross_timer_command_retries_total",
+    "Reintentos de comandos a dispositivos tras un error"
+))
+FAILURES = metrics.register(Counter(
+    "meross_timer_failures_total",
+    "Fallos por tipo: intento fallido, error no recuperable o trabajo terminado con error",
+    label="kind"
+))
+JOBS_FINISHED = metrics.register(Counter(
+    "meross_timer_jobs_finished_total",
+    "Trabajos terminados por resultado",
+    label="status"
+))
+TIMER_CONFLICTS = metrics.register(Counter(
+    "meross_timer_conflicts_total",
+    "Temporizadores sustituidos o descartados por la política de conflictos",
+    label="outcome"
+))
+COMMANDS_SKIPPED = metrics.register(Counter(
+    "meross_commands_skipped_total",
+    "Comandos no enviados porque el dispositivo ya estaba en el estado pedido",
+    label="source"
+))
+JOBS_DEFERRED = metrics.register(Counter(
+    "meross_timer_jobs_deferred_total",
+    "Trabajos aplazados por tener el circuito abierto"
+))
+
+def record_phase(phase, started):
+    """Registra la duración de una fase desde un time.perf_counter(); devuelve milisegundos"""
+    seconds = time.perf_counter() - started
+    PHASE_SECONDS.observe(seconds, phase)
+    return round(seconds * 1000, 1)
+
+# ===== ARRANQUE =====
+
+# Calentar en segundo plano la sesión Meross y la caché de dispositivos al arrancar
+STARTUP_WARM_UP = os.getenv('STARTUP_WARM_UP', 'true').lower() in ('1', 'true', 'yes')
+# Espera máxima del calentamiento antes de dar el arranque por terminado (segundos)
+STARTUP_WARM_UP_TIMEOUT = float(os.getenv('STARTUP_WARM_UP_TIMEOUT', 60))
+# Módulos pesados que no hacen falta para responder a / y /status
+LAZY_MODULES = ("aiohttp", "apscheduler.triggers.cron")
+
+def process_age():
+    """Segundos desde que arrancó este proceso (fork del worker en gunicorn); None fuera de Linux"""
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return None
+
+class StartupTimeline:
+    """Fases del arranque en frío y los hitos que importan en Render.
+
+    Las fases son duraciones; los hitos (primera respuesta, primer comando,
+    calentamiento terminado) se miden desde el inicio del proceso si /proc lo
+    permite y, si no, desde que empezó a cargarse este módulo. Cada fase e
+    hito se registra una sola vez: solo cuenta el primer arranque.
+    """
+
+    def __init__(self, started):
+        self.started = started
+        age = process_age()
+        # Tiempo del intérprete (y del fork de gunicorn) antes de la primera línea del módulo
+        self.interpreter = None if age is None else max(0.0, age - (time.perf_counter() - started))
+        self.reference = "module" if self.interpreter is None else "process"
+        self.phases = {}
+        self.milestones = {}
+        self._lock = threading.Lock()
+        if self.interpreter is not None:
+            self.phases["interpreter"] = round(self.interpreter * 1000, 1)
+
+    def record(self, phase, started, ended=None):
+        """Duración de una fase desde un time.perf_counter(); devuelve milisegundos"""
+        ms = round(((time.perf_counter() if ended is None else ended) - started) * 1000, 1)
+        with self._lock:
+            self.phases.setdefault(phase, ms)
+        return ms
+
+    def mark(self, milestone):
+        """Registra un hito la primera vez; devuelve sus milisegundos o None si ya estaba"""
+        if milestone in self.milestones:
+            return None
+        ms = round((time.perf_counter() - self.started + (self.interpreter or 0)) * 1000, 1)
+        with self._lock:
+            if milestone in self.milestones:
+                return None
+            self.milestones[milestone] = ms
+        log_message(f"⏱️ Arranque: {milestone} a los {ms} ms", phase="startup", milestone=milestone, elapsed_ms=ms)
+        return ms
+
+    def seconds(self):
+        with self._lock:
+            values = {**self.phases, **self.milestones}
+        return {name: round(ms / 1000, 4) for name, ms in values.items()}
+
+    def info(self):
+        with self._lock:
+            return {"reference": self.reference, "phases": dict(self.phases), "milestones": dict(self.milestones)}
+
+startup = StartupTimeline(STARTUP_STARTED)
+startup.record("imports", STARTUP_STARTED, IMPORTS_DONE)
+metrics.register(Gauge(
+    "meross_timer_startup_seconds",
+    "Duración de las fases del arranque y momento de cada hito",
+    startup.seconds,
+    label="step"
+))
+
+# ===== RESILIENCIA FRENTE A LA NUBE MEROSS =====
+
+# Reintentos: espera exponencial con jitter completo entre 0 y min(máx, base * 2^intento)
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', 2))
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', 60))
+# Límites de ritmo por cuenta: logins por minuto y comandos por segundo (con ráfaga)
+LOGIN_RATE_PER_MINUTE = float(os.getenv('LOGIN_RATE_PER_MINUTE', 4))
+LOGIN_BURST = int(os.getenv('LOGIN_BURST', 2))
+COMMAND_RATE_PER_SECOND = float(os.getenv('COMMAND_RATE_PER_SECOND', 5))
+COMMAND_BURST = int(os.getenv('COMMAND_BURST', 10))
+# Circuit breaker: fallos seguidos para abrirlo, segundos abierto y separación
+# entre los trabajos aplazados cuando la nube vuelve
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_RESET_TIMEOUT = float(os.getenv('BREAKER_RESET_TIMEOUT', 60))
+BREAKER_DRAIN_INTERVAL = float(os.getenv('BREAKER_DRAIN_INTERVAL', 0.5))
+
+# Errores que no se arreglan reintentando
+NON_RETRYABLE_ERRORS = (BadLoginException,)
+
+def backoff_delay(attempt, base=RETRY_BASE_DELAY, cap=RETRY_MAX_DELAY):
+    """Espera antes del reintento `attempt` (0, 1, ...): exponencial con jitter completo"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+class TokenBucket:
+    """Token bucket asíncrono; se usa siempre desde el loop de la sesión"""
+
+    def __init__(self, rate_per_second, capacity):
+        self.rate = rate_per_second
+        self.capacity = max(1, capacity)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        """Consume un token, esperando lo necesario si el cubo está vacío"""
+        while True:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class CircuitOpenError(Exception):
+    """La nube Meross está fallando: el trabajo debe aplazarse.
+
+    probing indica que hay una llamada de prueba en curso: el trabajo puede
+    esperar a su resultado en lugar de volver a intentarlo a ciegas.
+    """
+
+    def __init__(self, retry_after, probing=False):
+        super().__init__(f"Circuito abierto, reintentar en {retry_after:.0f}s")
+        self.retry_after = retry_after
+        self.probing = probing
+
+class CircuitBreaker:
+    """Circuit breaker de tres estados (closed / open / half_open).
+
+    Tras `failure_threshold` fallos seguidos se abre durante `reset_timeout`
+    segundos; después deja pasar una sola llamada de prueba y se cierra si
+    esa llamada tiene éxito. Lo consultan el planificador y el loop de la
+    sesión, por eso va protegido con un lock.
+
+    Los trabajos que llegan mientras la prueba está en curso se aparcan con
+    park() y se entregan a `on_unpark` cuando la prueba se resuelve. Al
+    reprogramarlos, drain_delay() reparte los huecos de BREAKER_DRAIN_INTERVAL
+    de toda la sesión, no solo los de un lote.
+    """
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_count = 0
+        self._opened_at = None
+        self._probe_in_flight = False
+        self._parked = []
+        self._drain_next = 0.0
+        self.on_unpark = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at < self.reset_timeout:
+            return "open"
+        return "half_open"
+
+    def retry_after(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 0.0
+            return max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+
+    def check(self):
+        """Lanza CircuitOpenError si ahora no se puede llamar a la nube"""
+        with self._lock:
+            state = self._state()
+            if state == "closed":
+                return
+            if state == "half_open" and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return
+            retry_after = max(BREAKER_DRAIN_INTERVAL, self.reset_timeout - (time.monotonic() - self._opened_at))
+            probing = state == "half_open"
+        raise CircuitOpenError(retry_after, probing)
+
+    def park(self, item):
+        """Aparca un trabajo hasta que se resuelva la prueba en curso; False si ya no hay prueba"""
+        with self._lock:
+            if not self._probe_in_flight:
+                return False
+            self._parked.append(item)
+            return True
+
+    def drain_delay(self, retry_after):
+        """Demora de un trabajo aplazado: tras retry_after, el siguiente hueco libre de la sesión"""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now + retry_after, self._drain_next)
+            self._drain_next = slot + BREAKER_DRAIN_INTERVAL
+        return slot - now
+
+    def _resolve_probe(self):
+        # Con el lock tomado: la prueba ha terminado y los aparcados pueden seguir
+        self._probe_in_flight = False
+        parked, self._parked = self._parked, []
+        return parked
+
+    def _unpark(self, parked):
+        if parked and self.on_unpark is not None:
+            self.on_unpark(parked)
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                log_message("🟢 Circuito cerrado: la nube Meross responde de nuevo")
+            self.failures = 0
+            self._opened_at = None
+            parked = self._resolve_probe()
+        self._unpark(parked)
+
+    def release(self):
+        """Libera la llamada de prueba sin contarla como éxito ni como fallo"""
+        with self._lock:
+            parked = self._resolve_probe()
+        self._unpark(parked)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            reopen = self._probe_in_flight
+            parked = self._resolve_probe()
+            if reopen or (self._opened_at is None and self.failures >= self.failure_threshold):
+                self._opened_at = time.monotonic()
+                self.opened_count += 1
+                log_message(f"🔴 Circuito abierto tras {self.failures} fallos: "
+                            f"pausa de {self.reset_timeout:.0f}s para la nube Meross")
+        self._unpark(parked)
+
+    def info(self):
+        return {"state": self.state, "failures": self.failures,
+                "retry_after": round(self.retry_after(), 1), "opened_count": self.opened_count}
+
+# ===== CUENTAS MEROSS =====
+
+# URL base de la API HTTP de Meross por región
+MEROSS_REGIONS = {
+    "eu": "https://iotx-eu.meross.com",
+    "us": "https://iotx-us.meross.com",
+    "ap": "https://iotx-ap.meross.com"
+}
+
+class MerossAccount:
+    """Credenciales, región y límites de ritmo de una cuenta Meross"""
+
+    __slots__ = ("name", "email", "password", "region", "api_base_url",
+                 "login_rate_per_minute", "login_burst", "command_rate_per_second", "command_burst")
+
+    def __init__(self, name, email, password, region="eu", api_base_url=None,
+                 login_rate_per_minute=LOGIN_RATE_PER_MINUTE, login_burst=LOGIN_BURST,
+                 command_rate_per_second=COMMAND_RATE_PER_SECOND, command_burst=COMMAND_BURST):
+        self.name = name
+        self.email = email
+        self.password = password
+        self.region = str(region).lower()
+        self.api_base_url = api_base_url or MEROSS_REGIONS.get(self.region)
+        if self.api_base_url is None:
+            raise ValueError(f"Región Meross desconocida '{region}' (usar {', '.join(MEROSS_REGIONS)})")
+        self.login_rate_per_minute = float(login_rate_per_minute)
+        self.login_burst = int(login_burst)
+        self.command_rate_per_second = float(command_rate_per_second)
+        self.command_burst = int(command_burst)
+
+    def info(self):
+        return {
+            "name": self.name,
+            "region": self.region,
+            "api_base_url": self.api_base_url,
+            "login_rate_per_minute": self.login_rate_per_minute,
+            "command_rate_per_second": self.command_rate_per_second
+        }
+
+def load_accounts():
+    """Cuentas de MEROSS_ACCOUNTS o, si no está, la de MEROSS_EMAIL/MEROSS_PASSWORD/MEROSS_REGION.
+
+    MEROSS_ACCOUNTS es JSON: {"casa": {"email": ..., "password": ..., "region": "eu",
+    "command_rate_per_second": 5, ...}, ...} o una lista de objetos con "name".
+    La primera cuenta es la que se usa cuando una petición no indica ninguna.
+    """
+    raw = os.getenv('MEROSS_ACCOUNTS')
+    entries = json.loads(raw) if raw else []
+    if isinstance(entries, dict):
+        entries = [{"name": name, **entry} for name, entry in entries.items()]
+    if not entries and os.getenv('MEROSS_EMAIL') and os.getenv('MEROSS_PASSWORD'):
+        entries = [{"name": "default", "email": os.getenv('MEROSS_EMAIL'),
+                    "password": os.getenv('MEROSS_PASSWORD'), "region": os.getenv('MEROSS_REGION', 'eu')}]
+    accounts = {}
+    for entry in entries:
+        account = MerossAccount(**{key: value for key, value in entry.items() if key in MerossAccount.__slots__})
+        accounts[account.name] = account
+    return accounts
+
+meross_accounts = load_accounts()  # nombre -> MerossAccount, en el orden configurado
+
+def find_account(name_or_email=None):
+    """Cuenta por nombre o email; sin indicar ninguna, la primera. None si no existe"""
+    if name_or_email is None:
+        return next(iter(meross_accounts.values()), None)
+    account = meross_accounts.get(name_or_email)
+    if account is None:
+        account = next((a for a in meross_accounts.values() if a.email == name_or_email), None)
+    return account
+
+def account_password(email):
+    """Contraseña configurada para un email (los trabajos del diario solo guardan el email)"""
+    account = find_account(email)
+    return account.password if account is not None and account.email == email else None
+
+def account_name(email):
+    account = find_account(email)
+    return account.name if account is not None and account.email == email else None
+
+def request_credentials(data=None):
+    """(email, contraseña, error) de la cuenta indicada en `account` (cuerpo o query string).
+
+    error es None o (mensaje, código HTTP).
+    """
+    requested = (data or {}).get('account') or request.args.get('account')
+    account = find_account(requested)
+    if account is None:
+        if requested:
+            return None, None, (f"Cuenta '{requested}' no configurada", 404)
+        return None, None, ("Variables de entorno no configuradas", 500)
+    return account.email, account.password, None
+
+# ===== CONTROL LOCAL (LAN) =====
+
+# Transporte de los comandos: "cloud" (MQTT de Meross) o "lan". Con "lan" el
+# manager de meross-iot usa TransportMode.LAN_HTTP_FIRST: cada comando va
+# primero al HTTP local del enchufe (device.lan_ip) y, si falla, por la nube;
+# los errores gastan un presupuesto por dispositivo que lo deja en la nube un rato
+MEROSS_TRANSPORT = os.getenv('MEROSS_TRANSPORT', 'cloud').lower()
+
+def lan_address(device):
+    """IP local por la que meross-iot enviará los comandos del dispositivo, o None"""
+    if MEROSS_TRANSPORT != "lan" or device is None:
+        return None
+    return getattr(device, 'lan_ip', None)
+
+class LanBreaker:
+    """Circuit breaker de los comandos que salen por la LAN: no frena ni cuenta nada.
+
+    meross-iot ya cae a la nube si el enchufe no responde; aplazar por el
+    circuito de la nube un comando que no la necesita solo lo retrasaría.
+    """
+
+    def check(self):
+        pass
+
+    def record_success(self):
+        pass
+
+    def release(self):
+        pass
+
+    def record_failure(self):
+        pass
+
+LAN_BREAKER = LanBreaker()
+
+# ===== SESIÓN MEROSS PERSISTENTE =====
+
+# Se asignan en load_meross_iot(): importar meross-iot arrastra aiohttp y
+# retrasaría la primera respuesta del worker
+MerossHttpClient = None
+MerossManager = None
+TransportMode = None
+meross_iot_lock = threading.Lock()
+
+def load_meross_iot():
+    """Importa el cliente HTTP y el manager de meross-iot (o los simulados) la primera vez"""
+    global MerossHttpClient, MerossManager, TransportMode
+    if MerossManager is not None:
+        return
+    with meross_iot_lock:
+        if MerossManager is not None:
+            return
+        started = time.perf_counter()
+        if MEROSS_FAKE_CLOUD:
+            from fake_meross import FakeMerossHttpClient as http_client, FakeMerossManager as manager
+        else:
+            from meross_iot.http_api import MerossHttpClient as http_client
+            from meross_iot.manager import MerossManager as manager
+        from meross_iot.manager import TransportMode as transport_mode
+        MerossHttpClient = http_client
+        MerossManager = manager
+        TransportMode = transport_mode
+        log_message(f"📦 meross-iot importado en {startup.record('meross_iot_import', started)} ms",
+                    phase="startup")
+
+# Errores que indican que la sesión (token o conexión MQTT) ya no es válida
+SESSION_ERRORS = (TokenExpiredException, UnauthorizedException, UnconnectedError)
+
+# Vida útil del descubrimiento de dispositivos y tiempo mínimo entre
+# descubrimientos forzados por búsquedas fallidas (segundos)
+DISCOVERY_TTL = int(os.getenv('MEROSS_DISCOVERY_TTL', 600))
+DISCOVERY_MISS_INTERVAL = int(os.getenv('MEROSS_DISCOVERY_MISS_INTERVAL', 30))
+
+# Espera máxima a la notificación push que confirma un cambio de estado antes
+# de recurrir a consultar el dispositivo (segundos)
+STATE_CONFIRM_TIMEOUT = float(os.getenv('STATE_CONFIRM_TIMEOUT', 3))
+
+# Segundos durante los que un estado en caché (push, lectura o comando) se da por bueno
+DEVICE_STATE_TTL = float(os.getenv('DEVICE_STATE_TTL', 120))
+
+class DeviceCache:
+    """Caché del descubrimiento con índices por nombre y uuid.
+
+    Las búsquedas son O(1) sobre diccionarios; el contenido caduca tras
+    `ttl` segundos o con invalidate().
+    """
+
+    def __init__(self, ttl=DISCOVERY_TTL):
+        self.ttl = ttl
+        self.by_name = {}
+        self.by_uuid = {}
+        self.refreshed_at = None  # time.monotonic() del último descubrimiento
+
+    def rebuild(self, devices):
+        self.by_name = {device.name: device for device in devices}
+        self.by_uuid = {device.uuid: device for device in devices}
+        self.refreshed_at = time.monotonic()
+
+    def invalidate(self):
+        self.by_name = {}
+        self.by_uuid = {}
+        self.refreshed_at = None
+
+    def age(self):
+        return None if self.refreshed_at is None else time.monotonic() - self.refreshed_at
+
+    def is_loaded(self):
+        return self.refreshed_at is not None
+
+    def is_fresh(self):
+        age = self.age()
+        return age is not None and age < self.ttl
+
+    def lookup(self, name_or_uuid):
+        return self.by_name.get(name_or_uuid) or self.by_uuid.get(name_or_uuid)
+
+    def all(self):
+        return list(self.by_uuid.values())
+
+    def info(self):
+        age = self.age()
+        return {
+            "devices": len(self.by_uuid),
+            "age_seconds": round(age, 1) if age is not None else None,
+            "fresh": self.is_fresh()
+        }
+
+class DeviceStateCache:
+    """Último estado on/off conocido de cada dispositivo (por uuid).
+
+    Lo alimentan las notificaciones push, las lecturas y los comandos
+    confirmados. Una entrada es fresca durante `ttl` segundos: pasado ese
+    tiempo se sigue mostrando en /devices, pero los trabajos vuelven a
+    consultar el dispositivo antes de decidir.
+    """
+
+    def __init__(self, ttl=DEVICE_STATE_TTL):
+        self.ttl = ttl
+        self._states = {}  # uuid -> (encendido, time.monotonic(), time.time(), origen)
+        self._online = {}  # uuid -> bool
+
+    def record(self, uuid, is_on, source):
+        if is_on is not None:
+            self._states[uuid] = (bool(is_on), time.monotonic(), time.time(), source)
+
+    def record_online(self, uuid, online):
+        self._online[uuid] = online
+
+    def fresh_state(self, uuid):
+        """Estado si es reciente y el dispositivo no consta como desconectado; si no, None"""
+        entry = self._states.get(uuid)
+        if entry is None or self._online.get(uuid) is False:
+            return None
+        return entry[0] if time.monotonic() - entry[1] < self.ttl else None
+
+    def invalidate(self):
+        self._states = {}
+        self._online = {}
+
+    def view(self, uuid):
+        entry = self._states.get(uuid)
+        if entry is None:
+            return {"state": "unknown", "state_age_seconds": None, "fresh": False, "source": None, "updated_at": None}
+        age = time.monotonic() - entry[1]
+        return {
+            "state": "on" if entry[0] else "off",
+            "state_age_seconds": round(age, 1),
+            "fresh": age < self.ttl and self._online.get(uuid) is not False,
+            "source": entry[3],
+            "updated_at": datetime.fromtimestamp(entry[2], SPAIN_TZ).isoformat()
+        }
+
+    def online(self, uuid):
+        return self._online.get(uuid)
+
+    def info(self):
+        now = time.monotonic()
+        return {"entries": len(self._states), "ttl_seconds": self.ttl,
+                "fresh": sum(1 for entry in list(self._states.values()) if now - entry[1] < self.ttl)}
+
+class MerossSession:
+    """Sesión Meross de larga duración sobre un event loop en un hilo dedicado.
+
+    Mantiene abiertos el cliente HTTP y la conexión MQTT entre trabajos y solo
+    vuelve a autenticarse cuando el token caduca o se pierde la conexión.
+    """
+
+    def __init__(self, account):
+        self.account = account
+        self.email = account.email
+        self.password = account.password
+        self.api_base_url = account.api_base_url
+        self.http_api_client = None
+        self.manager = None
+        self.connected_at = None
+        self.login_count = 0
+        self.devices = DeviceCache()
+        self.breaker = CircuitBreaker()
+        self.breaker.on_unpark = lambda jobs: defer_jobs(self, jobs, self.breaker.retry_after())
+        self.login_bucket = TokenBucket(account.login_rate_per_minute / 60, account.login_burst)
+        self.command_bucket = TokenBucket(account.command_rate_per_second, account.command_burst)
+        self._connect_lock = asyncio.Lock()
+        self._discovery_task = None
+        self._state_waiters = {}  # uuid -> [(estado esperado, future)]
+        self.states = DeviceStateCache()
+        self.warm_up_future = None
+        self._loop = asyncio.new_event_loop()
+        # Un loop por cuenta: una cuenta lenta o caída no retrasa los trabajos de las demás
+        self._thread = threading.Thread(target=self._run_loop, name=f"meross-session-{account.name}", daemon=True)
+        self._thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_forever()
+        finally:
+            self._loop.close()
+
+    @property
+    def loop(self):
+        return self._loop
+
+    @property
+    def connected(self):
+        return self.manager is not None
+
+    def submit(self, coro):
+        """Envía una corrutina al loop de la sesión y devuelve un concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def run(self, coro, timeout=None):
+        """Ejecuta una corrutina en el loop de la sesión y espera su resultado"""
+        return self.submit(coro).result(timeout)
+
+    async def async_get_manager(self, job_id="session"):
+        """Devuelve el manager conectado, haciendo login solo si hace falta"""
+        async with self._connect_lock:
+            if self.manager is None:
+                await self._async_connect(job_id)
+            return self.manager
+
+    async def _async_connect(self, job_id):
+        # Normalmente ya lo ha hecho el calentamiento del arranque
+        load_meross_iot()
+        await self.login_bucket.acquire()
+        started = time.perf_counter()
+        # Conectar con meross-iot - API corregida para v0.4.9.0
+        self.http_api_client = await MerossHttpClient.async_from_user_password(
+            api_base_url=self.api_base_url,
+            email=self.email,
+            password=self.password
+        )
+        self.login_count += 1
+        log_message(f"✅ [{job_id}] Login exitoso con meross-iot (login #{self.login_count})",
+                    job_id=job_id, phase="login", duration_ms=record_phase("login", started))
+
+        started = time.perf_counter()
+        try:
+            manager = MerossManager(http_client=self.http_api_client)
+            if MEROSS_TRANSPORT == "lan":
+                manager.default_transport_mode = TransportMode.LAN_HTTP_FIRST
+            await manager.async_init()
+        except Exception:
+            await self._async_logout()
+            raise
+        manager.register_push_notification_handler_coroutine(self._async_on_push)
+        self.manager = manager
+        self.connected_at = datetime.now(SPAIN_TZ)
+        log_message(f"✅ [{job_id}] Manager inicializado",
+                    job_id=job_id, phase="manager_init", duration_ms=record_phase("manager_init", started))
+
+    async def _async_on_push(self, push_notification, target_devices, manager):
+        """Resuelve las esperas de confirmación con los estados que llegan por MQTT"""
+        uuid = push_notification.originating_device_uuid
+        online = push_online_state(push_notification.raw_data)
+        if online is not None:
+            self.states.record_online(uuid, online)
+        state = push_onoff_state(push_notification.raw_data)
+        if state is None:
+            return
+        self.states.record(uuid, state, "push")
+        if uuid not in self._state_waiters:
+            return
+        waiters = self._state_waiters[uuid]
+        for expected, future in list(waiters):
+            if expected == state and not future.done():
+                future.set_result("push")
+                waiters.remove((expected, future))
+        if not waiters:
+            del self._state_waiters[uuid]
+
+    def expect_state(self, uuid, is_on):
+        """Registra una espera que se resuelve cuando el dispositivo notifique ese estado"""
+        future = self._loop.create_future()
+        self._state_waiters.setdefault(uuid, []).append((is_on, future))
+        return future
+
+    def discard_state_waiter(self, uuid, future):
+        waiters = self._state_waiters.get(uuid, [])
+        for entry in list(waiters):
+            if entry[1] is future:
+                waiters.remove(entry)
+        if not waiters:
+            self._state_waiters.pop(uuid, None)
+
+    async def async_invalidate(self, reason=""):
+        """Descarta la sesión actual; el siguiente uso volverá a autenticarse"""
+        async with self._connect_lock:
+            if self.manager is None and self.http_api_client is None:
+                return
+            log_message(f"🔄 Sesión Meross invalidada{': ' + reason if reason else ''}")
+            # Los dispositivos pertenecen al manager que se descarta y sin
+            # conexión MQTT se han podido perder notificaciones de estado
+            self.devices.invalidate()
+            self.states.invalidate()
+            if self.manager:
+                self.manager.close()
+                self.manager = None
+            await self._async_logout()
+            self.connected_at = None
+
+    async def async_refresh_devices(self, job_id="session"):
+        """Lanza un descubrimiento (uno solo a la vez) y reconstruye los índices"""
+        if self._discovery_task is None or self._discovery_task.done():
+            self._discovery_task = asyncio.ensure_future(self._async_discover(job_id))
+        return await asyncio.shield(self._discovery_task)
+
+    async def _async_discover(self, job_id):
+        manager = await self.async_get_manager(job_id)
+        started = time.perf_counter()
+        await manager.async_device_discovery()
+        devices = manager.find_devices()
+        self.devices.rebuild(devices)
+        log_message(f"🔍 [{job_id}] Descubrimiento completado: {len(devices)} dispositivos",
+                    job_id=job_id, phase="discovery", duration_ms=record_phase("discovery", started))
+        return devices
+
+    def _refresh_in_background(self, job_id):
+        if self._discovery_task is None or self._discovery_task.done():
+            task = asyncio.ensure_future(self.async_refresh_devices(job_id))
+            task.add_done_callback(_log_background_error)
+
+    def breaker_for(self, device_name):
+        """Circuit breaker que gobierna un comando: ninguno si va a ir por la LAN.
+
+        Solo con la sesión caliente se sabe sin ir a la red si el dispositivo
+        tiene IP local; mientras tanto manda el circuito de la nube.
+        """
+        if self.connected and self.devices.is_loaded() and lan_address(self.devices.lookup(device_name)):
+            return LAN_BREAKER
+        return self.breaker
+
+    async def async_find_device(self, device_name, job_id="session"):
+        """Busca un dispositivo por nombre o uuid sin ir a la red si la caché lo conoce.
+
+        Si la entrada está caducada se devuelve igualmente y se refresca en
+        segundo plano; solo un fallo de búsqueda fuerza un descubrimiento.
+        """
+        if not self.devices.is_loaded():
+            await self.async_refresh_devices(job_id)
+
+        device = self.devices.lookup(device_name)
+        if device is not None:
+            if not self.devices.is_fresh():
+                self._refresh_in_background(job_id)
+            return device
+
+        # Sin edad es que otra corrutina invalidó la caché durante el refresco
+        age = self.devices.age()
+        if age is None or age >= DISCOVERY_MISS_INTERVAL:
+            log_message(f"🔍 [{job_id}] '{device_name}' no está en caché, redescubriendo...",
+                        job_id=job_id, device=device_name, phase="discovery")
+            await self.async_refresh_devices(job_id)
+            return self.devices.lookup(device_name)
+        return None
+
+    async def async_list_devices(self, job_id="session"):
+        """Lista de dispositivos, redescubriendo solo si la caché ha caducado"""
+        if not self.devices.is_fresh():
+            await self.async_refresh_devices(job_id)
+        return self.devices.all()
+
+    async def _async_logout(self):
+        if self.http_api_client:
+            try:
+                await self.http_api_client.async_logout()
+            except Exception as e:
+                log_message(f"⚠️ Error cerrando sesión Meross: {str(e)}")
+            self.http_api_client = None
+
+    def close(self, timeout=10):
+        """Cierra la sesión y detiene el loop del hilo dedicado"""
+        future = self.submit(self.async_invalidate("cierre de la sesión"))
+        future.add_done_callback(lambda _: self._loop.call_soon_threadsafe(self._loop.stop))
+        # Desde el propio loop no se puede esperar: el cierre queda programado
+        if threading.current_thread() is not self._thread:
+            try:
+                future.result(timeout)
+            except Exception as e:
+                log_message(f"⚠️ Error cerrando sesión Meross: {str(e)}")
+
+    def info(self):
+        return {
+            "account": self.account.name,
+            "region": self.account.region,
+            "connected": self.connected,
+            "connected_at": self.connected_at.isoformat() if self.connected_at else None,
+            "logins": self.login_count,
+            "device_cache": self.devices.info(),
+            "state_cache": self.states.info(),
+            "lan": {"enabled": MEROSS_TRANSPORT == "lan",
+                    "devices_with_lan_ip": sum(1 for device in self.devices.all() if lan_address(device))},
+            "circuit_breaker": self.breaker.info()
+        }
+
+def push_online_state(raw_data):
+    """Extrae la conexión (online/offline) de una notificación System.Online"""
+    if not isinstance(raw_data, dict) or not isinstance(raw_data.get('online'), dict):
+        return None
+    status = raw_data['online'].get('status')
+    return None if status is None else status == 1
+
+def push_onoff_state(raw_data):
+    """Extrae el estado on/off (canal 0) de una notificación Toggle/ToggleX"""
+    if not isinstance(raw_data, dict):
+        return None
+    payload = raw_data.get('togglex', raw_data.get('toggle'))
+    if isinstance(payload, list):
+        payload = next((c for c in payload if c.get('channel', 0) == 0), None)
+    if not isinstance(payload, dict) or 'onoff' not in payload:
+        return None
+    return payload['onoff'] == 1
+
+async def confirm_device_state(session, device, target_state, waiter, job_id):
+    """Espera la confirmación push del nuevo estado; si no llega, consulta el dispositivo.
+
+    Devuelve (estado, método de confirmación).
+    """
+    try:
+        method = await asyncio.wait_for(asyncio.shield(waiter), STATE_CONFIRM_TIMEOUT)
+        return target_state, method
+    except asyncio.TimeoutError:
+        log_message(f"⌛ [{job_id}] Sin confirmación push en {STATE_CONFIRM_TIMEOUT}s, consultando estado...",
+                    job_id=job_id, device=device.name, phase="verify")
+        await device.async_update()
+        return device.is_on(), "poll"
+    finally:
+        session.discard_state_waiter(device.uuid, waiter)
+
+def _log_background_error(task):
+    if not task.cancelled() and task.exception() is not None:
+        log_message(f"⚠️ Error en tarea en segundo plano: {str(task.exception())}")
+
+# Una sesión por cuenta Meross, compartida por todos los trabajos y endpoints
+meross_sessions = {}
+meross_sessions_lock = threading.Lock()
+
+def get_meross_session(email, password):
+    """Devuelve (creándola si no existe) la sesión compartida de una cuenta"""
+    with meross_sessions_lock:
+        session = meross_sessions.get(email)
+        if session is None or session.password != password:
+            if session is not None:
+                session.close()
+            account = find_account(email)
+            if account is None or account.email != email or account.password != password:
+                # Credenciales fuera de MEROSS_ACCOUNTS: región y límites por defecto
+                account = MerossAccount(email, email, password)
+            session = MerossSession(account)
+            meross_sessions[email] = session
+        return session
+
+@atexit.register
+def close_meross_sessions():
+    with meross_sessions_lock:
+        for session in meross_sessions.values():
+            session.close()
+        meross_sessions.clear()
+
+async def control_device_meross_iot(email, password, device_name, action, job_id, max_retries=3,
+                                    fire_at=None, on_fire=None):
+    """Control usando meross-iot sobre la sesión compartida (ejecutar en el loop de la sesión).
+
+    Con MEROSS_TRANSPORT=lan meross-iot envía la lectura y el comando por la
+    LAN y, si el dispositivo no responde, por la nube.
+    Con fire_at (epoch) se prepara todo lo posible y el comando espera a ese
+    instante; on_fire se llama justo entonces y, si devuelve False, el
+    trabajo se da por cancelado sin enviar nada.
+    """
+    session = get_meross_session(email, password)
+    fired = False
+
+    def report(result):
+        if fire_at is not None:
+            result["firing_error_ms"] = round((time.time() - fire_at) * 1000, 1)
+        return result
+
+    for attempt in range(max_retries):
+        # Con la nube caída no se insiste (CircuitOpenError aplaza el trabajo),
+        # salvo que el comando vaya por la LAN
+        breaker = session.breaker_for(device_name)
+        breaker.check()
+        prepare_kind = "warm" if session.connected and session.devices.is_loaded() else "cold"
+        prepare_started = time.perf_counter()
+        try:
+            log_message(f"🔧 [{job_id}] Intento {attempt + 1}/{max_retries} - Controlando {device_name} -> {action}",
+                        job_id=job_id, device=device_name, phase="attempt", attempt=attempt + 1)
+            
+            # Buscar el dispositivo en la caché de descubrimiento
+            started = time.perf_counter()
+            device = await session.async_find_device(device_name, job_id)
+            
+            if device is None:
+                # La nube ha respondido: el fallo es del nombre, no del servicio
+                breaker.record_success()
+                available = list(session.devices.by_name)
+                return {
+                    "status": "error", 
+                    "message": f"Dispositivo '{device_name}' no encontrado. Disponibles: {available}"
+                }
+                
+            log_message(f"✅ [{job_id}] Dispositivo encontrado: {device.name}",
+                        job_id=job_id, device=device_name, phase="lookup", duration_ms=record_phase("lookup", started))
+            
+            transport = "lan" if lan_address(device) else "cloud"
+            
+            # Estado actual: de la caché si es reciente, si no consultando
+            current_state = session.states.fresh_state(device.uuid)
+            state_source = "cache"
+            if current_state is None:
+                await session.command_bucket.acquire()
+                started = time.perf_counter()
+                await device.async_update()
+                current_state = device.is_on()
+                session.states.record(device.uuid, current_state, "poll")
+                state_source = "poll"
+                log_message(f"📊 [{job_id}] Estado actual: {'🟢 ENCENDIDO' if current_state else '🔴 APAGADO'}",
+                            job_id=job_id, device=device_name, phase="state_read", duration_ms=record_phase("state_read", started))
+            
+            # Preparado: el comando espera al instante exacto de disparo
+            if not fired:
+                prepare_latency.observe(prepare_kind, record_phase("prepare", prepare_started) / 1000)
+                wait = fire_at - time.time() if fire_at is not None else 0
+                if wait > 0:
+                    log_message(f"🎯 [{job_id}] Preparado, disparo en {wait * 1000:.0f} ms",
+                                job_id=job_id, device=device_name, phase="armed", duration_ms=round(wait * 1000, 1))
+                    await asyncio.sleep(wait)
+                fired = True
+                if on_fire is not None and not on_fire():
+                    breaker.release()
+                    return {"status": "cancelled", "message": f"Trabajo {job_id} cancelado antes del disparo"}
+                # Un push recibido durante la espera manda sobre la lectura previa
+                cached_state = session.states.fresh_state(device.uuid)
+                if cached_state is not None:
+                    current_state = cached_state
+            
+            # Ya está en el estado pedido: no hace falta enviar el comando
+            target_state = action.lower() == 'on'
+            if current_state == target_state:
+                if state_source == "cache":
+                    breaker.release()
+                else:
+                    breaker.record_success()
+                COMMANDS_SKIPPED.inc(state_source)
+                log_message(f"⏭️ [{job_id}] {device.name} ya está {'ENCENDIDO' if target_state else 'APAGADO'} "
+                            f"(según {state_source}), no se envía el comando",
+                            job_id=job_id, device=device_name, phase="verify", confirmed_by=state_source)
+                return report({
+                    "status": "success",
+                    "message": f"{device.name} ya estaba en '{action}'",
+                    "previous_state": "on" if current_state else "off",
+                    "new_state": "on" if current_state else "off",
+                    "confirmed_by": state_source,
+                    "confirmation_latency_ms": 0
+                })
+            
+            # Ejecutar acción; la espera de confirmación se registra antes de
+            # enviar para no perder una notificación que llegue con el ACK
+            waiter = session.expect_state(device.uuid, target_state)
+            await session.command_bucket.acquire()
+            command_sent = time.monotonic()
+            result = report({})
+            started = time.perf_counter()
+            try:
+                if target_state:
+                    await device.async_turn_on()
+                    log_message(f"🔌 [{job_id}] {device.name} ENCENDIDO",
+                                job_id=job_id, device=device_name, phase="command", duration_ms=record_phase("command", started),
+                                transport=transport)
+                else:
+                    await device.async_turn_off()
+                    log_message(f"🔌 [{job_id}] {device.name} APAGADO",
+                                job_id=job_id, device=device_name, phase="command", duration_ms=record_phase("command", started),
+                                transport=transport)
+            except Exception:
+                session.discard_state_waiter(device.uuid, waiter)
+                raise
+            startup.mark("first_command")
+            
+            # Verificar resultado por push (o consultando si no llega a tiempo)
+            new_state, confirmed_by = await confirm_device_state(session, device, target_state, waiter, job_id)
+            confirmation_ms = round((time.monotonic() - command_sent) * 1000, 1)
+            PHASE_SECONDS.observe(confirmation_ms / 1000, "verify")
+            session.states.record(device.uuid, new_state, confirmed_by)
+            log_message(f"✅ [{job_id}] Nuevo estado: {'🟢 ENCENDIDO' if new_state else '🔴 APAGADO'} "
+                        f"(confirmado por {confirmed_by} en {confirmation_ms} ms)",
+                        job_id=job_id, device=device_name, phase="verify", duration_ms=confirmation_ms,
+                        confirmed_by=confirmed_by)
+            breaker.record_success()
+            
+            return {
+                "status": "success", 
+                "message": f"Acción '{action}' ejecutada en {device.name}",
+                "previous_state": "on" if current_state else "off",
+                "new_state": "on" if new_state else "off",
+                "confirmed_by": confirmed_by,
+                "transport": transport,
+                "confirmation_latency_ms": confirmation_ms,
+                **result
+            }
+            
+        except NON_RETRYABLE_ERRORS as e:
+            log_message(f"💥 [{job_id}] Error no recuperable: {str(e)}",
+                        job_id=job_id, device=device_name, phase="error")
+            FAILURES.inc("non_retryable")
+            breaker.release()
+            return {"status": "error", "message": f"Error no recuperable: {str(e)}"}
+            
+        except Exception as e:
+            log_message(f"💥 [{job_id}] Error en intento {attempt + 1}: {str(e)}",
+                        job_id=job_id, device=device_name, phase="error", attempt=attempt + 1)
+            FAILURES.inc("attempt")
+            breaker.record_failure()
+            if isinstance(e, SESSION_ERRORS):
+                await session.async_invalidate(type(e).__name__)
+            if attempt < max_retries - 1:
+                wait_time = backoff_delay(attempt)
+                RETRIES.inc()
+                log_message(f"⏳ [{job_id}] Esperando {wait_time:.1f} segundos antes del siguiente intento...",
+                            job_id=job_id, device=device_name, phase="backoff", duration_ms=round(wait_time * 1000))
+                await asyncio.sleep(wait_time)
+            else:
+                return {"status": "error", "message": f"Error después de {max_retries} intentos: {str(e)}"}
+
+# ===== REGISTRO DE TRABAJOS =====
+
+# Tamaño de página por defecto y máximo de /jobs
+JOBS_PAGE_SIZE = int(os.getenv('JOBS_PAGE_SIZE', 100))
+JOBS_PAGE_MAX = int(os.getenv('JOBS_PAGE_MAX', 1000))
+# /jobs calcula los tiempos restantes al inicio de franjas de estos segundos (el
+# instante va en `timestamp`): dentro de una franja la respuesta es la misma y el
+# ETag, versión del registro más franja, puede contestar 304 sin mentir
+JOBS_ETAG_INTERVAL = float(os.getenv('JOBS_ETAG_INTERVAL', 5))
+
+# Identifica este worker y este arranque en ETags e ids de eventos
+WORKER_INSTANCE = f"{os.getpid():x}.{int(time.time()):x}"
+
+class JobRecord:
+    """Trabajo activo con instantes en epoch y textos de fecha ya formateados"""
+
+    __slots__ = ("job_id", "seq", "device_name", "action", "start", "due", "status",
+                 "deferred_until", "execution_time", "execution_time_spain", "rule_id", "account")
+
+    def __init__(self, job_id, device_name, action, start, due, status="waiting", rule_id=None, account=None):
+        self.job_id = job_id
+        self.rule_id = rule_id
+        self.account = account
+        self.seq = 0
+        self.device_name = device_name
+        self.action = action
+        self.start = start
+        self.due = due
+        self.status = status
+        self.deferred_until = None
+        # Se formatea una sola vez: /jobs no vuelve a parsear fechas
+        due_spain = datetime.fromtimestamp(due, SPAIN_TZ)
+        self.execution_time = due_spain.isoformat()
+        self.execution_time_spain = due_spain.strftime('%H:%M:%S %d/%m/%Y')
+
+    def to_dict(self, now):
+        remaining_seconds = max(0, int(self.due - now))
+        job_info = {
+            "id": self.job_id,
+            "name": f"Control {self.device_name} -> {self.action}",
+            "device": self.device_name,
+            "action": self.action,
+            "execution_time": self.execution_time,
+            "execution_time_spain": self.execution_time_spain,
+            "status": self.status,
+            "remaining_minutes": remaining_seconds // 60,
+            "remaining_seconds": remaining_seconds
+        }
+        if self.rule_id is not None:
+            job_info["schedule_id"] = self.rule_id
+        if self.account is not None:
+            job_info["account"] = self.account
+        if self.deferred_until is not None:
+            job_info["deferred_until"] = datetime.fromtimestamp(self.deferred_until, SPAIN_TZ).isoformat()
+        return job_info
+
+class JobRegistry:
+    """Trabajos activos de este worker con índices por dispositivo y por estado.
+
+    Cada alta, baja o cambio de estado incrementa la versión; /jobs la usa como
+    ETag, así que un sondeo sin cambios se responde con 304 sin recorrer nada.
+    Los registros se recorren en orden de alta (seq), que sirve de cursor.
+    """
+
+    def __init__(self):
+        self._jobs = {}
+        self._by_device = {}
+        self._by_status = {}
+        self._lock = threading.RLock()
+        self._seq = itertools.count(1)
+        self._version = 0
+
+    def __contains__(self, job_id):
+        return job_id in self._jobs
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    @property
+    def etag(self):
+        # Distingue workers y reinicios: versiones iguales no implican mismo contenido
+        return f"{WORKER_INSTANCE}.{self._version}"
+
+    def _index(self, record):
+        self._by_device.setdefault(record.device_name, set()).add(record.job_id)
+        self._by_status.setdefault(record.status, set()).add(record.job_id)
+
+    def _unindex(self, record):
+        for index, key in ((self._by_device, record.device_name), (self._by_status, record.status)):
+            ids = index.get(key)
+            if ids is not None:
+                ids.discard(record.job_id)
+                if not ids:
+                    del index[key]
+
+    def add(self, record):
+        with self._lock:
+            previous = self._jobs.pop(record.job_id, None)
+            if previous is not None:
+                self._unindex(previous)
+            record.seq = next(self._seq)
+            self._jobs[record.job_id] = record
+            self._index(record)
+            self._version += 1
+
+    def remove(self, job_id):
+        with self._lock:
+            record = self._jobs.pop(job_id, None)
+            if record is not None:
+                self._unindex(record)
+                self._version += 1
+            return record
+
+    def set_status(self, job_id, status, deferred_until=None):
+        with self._lock:
+            record = self._jobs.get(job_id)
+            if record is None:
+                return None
+            self._unindex(record)
+            record.status = status
+            record.deferred_until = deferred_until
+            self._index(record)
+            self._version += 1
+            return record
+
+    def pending_for(self, device_name, action, account=None):
+        """Temporizadores sueltos aún sin ejecutar de un dispositivo y acción (sin ocurrencias de reglas)"""
+        with self._lock:
+            return [self._jobs[job_id] for job_id in self._by_device.get(device_name, ())
+                    if self._jobs[job_id].action == action
+                    and self._jobs[job_id].account == account
+                    and self._jobs[job_id].status in ("waiting", "deferred", "preparing")
+                    and self._jobs[job_id].rule_id is None]
+
+    def count_by_status(self):
+        with self._lock:
+            return {status: len(ids) for status, ids in self._by_status.items()}
+
+    def clear(self):
+        with self._lock:
+            self._jobs.clear()
+            self._by_device.clear()
+            self._by_status.clear()
+            self._version += 1
+
+    def query(self, device=None, status=None, cursor=0, limit=JOBS_PAGE_SIZE):
+        """Devuelve (página, total filtrado, cursor siguiente o None)"""
+        with self._lock:
+            if device is None and status is None:
+                # El diccionario ya está en orden de alta
+                records = list(self._jobs.values())
+            else:
+                ids = None
+                for index, key in ((self._by_device, device), (self._by_status, status)):
+                    if key is None:
+                        continue
+                    matched = index.get(key, set())
+                    ids = matched if ids is None else ids & matched
+                records = sorted((self._jobs[job_id] for job_id in ids), key=lambda r: r.seq)
+
+        start = bisect.bisect_right(records, cursor, key=lambda r: r.seq) if cursor else 0
+        page = records[start:start + limit]
+        next_cursor = page[-1].seq if start + limit < len(records) else None
+        return page, len(records), next_cursor
+
+job_registry = JobRegistry()
+
+# ===== EVENTOS DE TRABAJOS =====
+
+# Eventos que se conservan para que un cliente reconecte sin perder nada
+EVENT_LOG_SIZE = int(os.getenv('EVENT_LOG_SIZE', 1000))
+# Comentario keepalive del stream SSE y duración máxima de cada conexión (segundos):
+# al cortarse, EventSource reconecta solo con Last-Event-ID y libera el hilo mientras
+EVENTS_HEARTBEAT = float(os.getenv('EVENTS_HEARTBEAT', 15))
+EVENTS_STREAM_TIMEOUT = float(os.getenv('EVENTS_STREAM_TIMEOUT', 300))
+# Cada stream ocupa un hilo de gunicorn todo ese tiempo: por encima de este
+# número se responde 503 para que queden hilos para /timer y el resto
+EVENTS_MAX_STREAMS = int(os.getenv('EVENTS_MAX_STREAMS', max(1, int(os.getenv('GUNICORN_THREADS', 8)) // 4)))
+# Espera máxima de /jobs/<id>/wait (segundos)
+JOB_WAIT_MAX = float(os.getenv('JOB_WAIT_MAX', 60))
+
+FINAL_EVENTS = ("completed", "failed", "cancelled")
+
+class JobEventLog:
+    """Historial acotado (anillo) de eventos del ciclo de vida de los trabajos.
+
+    Cada evento lleva un id creciente; los clientes reanudan pidiendo los
+    posteriores a su último id. Los ids solo valen dentro de este worker: un id
+    de otra instancia (u olvidado por el anillo) se responde con todo lo que
+    queda y `gap` a True.
+    """
+
+    def __init__(self, capacity=EVENT_LOG_SIZE):
+        self._events = collections.deque(maxlen=capacity)
+        self._last_id = 0
+        self._cond = threading.Condition()
+
+    def publish(self, kind, job_id, **data):
+        with self._cond:
+            self._last_id += 1
+            event = {
+                "id": self._last_id,
+                "type": kind,
+                "job_id": job_id,
+                "timestamp": datetime.now(SPAIN_TZ).isoformat(),
+                **data
+            }
+            self._events.append(event)
+            self._cond.notify_all()
+        return event
+
+    def format_id(self, event):
+        return f"{WORKER_INSTANCE}:{event['id']}"
+
+    def parse_id(self, value):
+        """Convierte un Last-Event-ID en número; None si no es de este worker"""
+        instance, _, number = (value or "").rpartition(":")
+        if instance != WORKER_INSTANCE or not number.isdigit():
+            return None
+        return int(number)
+
+    def since(self, last_id):
+        """Eventos posteriores a last_id y si faltan eventos intermedios"""
+        with self._cond:
+            return self._since(last_id)
+
+    def _since(self, last_id):
+        if last_id is None:
+            return list(self._events), True
+        if last_id >= self._last_id:
+            return [], False
+        oldest = self._events[0]["id"] if self._events else self._last_id + 1
+        start = max(0, last_id + 1 - oldest)
+        return list(itertools.islice(self._events, start, None)), last_id + 1 < oldest
+
+    def wait(self, last_id, timeout):
+        """Como since(), pero espera hasta timeout a que haya algo nuevo"""
+        with self._cond:
+            if last_id is not None:
+                self._cond.wait_for(lambda: self._last_id > last_id, timeout)
+            return self._since(last_id)
+
+    def _find_final(self, job_id):
+        for event in reversed(self._events):
+            if event["job_id"] == job_id and event["type"] in FINAL_EVENTS:
+                return event
+        return None
+
+    def find_final(self, job_id):
+        with self._cond:
+            return self._find_final(job_id)
+
+    def wait_final(self, job_id, timeout):
+        """Espera el evento final (completado, fallido o cancelado) de un trabajo"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                event = self._find_final(job_id)
+                remaining = deadline - time.monotonic()
+                if event is not None or remaining <= 0:
+                    return event
+                self._cond.wait(remaining)
+
+    def info(self):
+        return {"buffered": len(self._events), "capacity": self._events.maxlen, "last_id": self._last_id}
+
+job_events = JobEventLog()
+
+def publish_job_result(job_id, result, device=None):
+    """Evento final de un trabajo ejecutado: completed si tuvo éxito, failed si no"""
+    kind = "completed" if result.get("status") == "success" else "failed"
+    return job_events.publish(kind, job_id, device=device, result=result)
+
+# ===== DIARIO DE TRABAJOS =====
+
+# Ruta del diario de trabajos (vacía para desactivar la persistencia)
+JOURNAL_PATH = os.getenv('JOB_JOURNAL_PATH', 'jobs.journal')
+# Entradas muertas (completadas/canceladas) que se toleran antes de compactar
+JOURNAL_COMPACT_MIN = int(os.getenv('JOB_JOURNAL_COMPACT_MIN', 1000))
+# Cada cuánto lee cada worker lo que otros workers han añadido al diario (segundos)
+JOURNAL_TAIL_INTERVAL = float(os.getenv('JOB_JOURNAL_TAIL_INTERVAL', 0.25))
+
+# Los eventos se escriben siempre como {"e":"<tipo>","id":"<id>",...}: al
+# reproducir se extraen tipo e id con una sola expresión sobre todo el fichero
+# y solo se decodifica el JSON completo de los trabajos que siguen pendientes.
+# Eventos que mantienen algo vivo en el diario; cualquier otro con el mismo id lo cierra
+JOURNAL_LIVE_EVENTS = ("schedule", "rule", "scene")
+# Avisos entre workers (cambios de estado, peticiones de cancelación): ni
+# mantienen vivo ni cierran nada y la compactación los descarta
+JOURNAL_NOTICE_EVENTS = ("status", "cancel_request")
+_JOURNAL_LINE_RE = re.compile(r'^(\{"e":"(\w+)","id":"([^"\\\n]*(?:\\.[^"\\\n]*)*)".*)', re.M)
+
+class FileLock:
+    """Lock exclusivo entre procesos sobre un fichero (flock); sin fcntl no bloquea nada"""
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._thread_lock = threading.Lock()
+
+    def acquire(self, blocking=True):
+        if not self._thread_lock.acquire(blocking):
+            return False
+        if fcntl is None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except OSError:
+            os.close(fd)
+            self._thread_lock.release()
+            return False
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        self._thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class JobJournal:
+    """Diario append-only de eventos de trabajos (una línea JSON por evento).
+
+    Los eventos son `schedule`, `cancel` y `complete`, más los avisos `status`
+    y `cancel_request` para los seguidores, marcados con el pid del worker que
+    los escribe. Un hilo escritor agrupa todo lo acumulado en una
+    sola escritura + fsync bajo un flock, así que varios workers pueden
+    compartir el fichero. Lo que llega mientras un fsync está en curso va junto
+    en el siguiente, sin esperas cuando el diario está ocioso; cada uno lee con read_new_events() lo que añaden los
+    demás. Solo el worker líder compacta: al arrancar y, en marcha, cuando las
+    entradas muertas superan a las vivas, así que reproducirlo cuesta lo mismo
+    que el número de trabajos pendientes.
+    """
+
+    def __init__(self, path, compact_min=JOURNAL_COMPACT_MIN):
+        self.path = path
+        self.compact_min = compact_min
+        self.worker_id = os.getpid()
+        self.compaction_enabled = False
+        self.stats = {"replayed_entries": 0, "replay_ms": 0.0, "pending_restored": 0,
+                      "fsyncs": 0, "compactions": 0}
+        self._live = {}          # id -> línea del evento `schedule` aún pendiente
+        self._dead = 0
+        self._pending = []       # (línea, threading.Event o None) por escribir
+        self._cond = threading.Condition()
+        self._file_lock = FileLock(f"{path}.lock")
+        self._file = None
+        self._thread = None
+        self._tail_inode = None
+        self._tail_offset = 0
+
+    def replay(self, compact=True):
+        """Lee el diario y devuelve los eventos `schedule` pendientes; con compact reescribe el fichero"""
+        started = time.perf_counter()
+        live = {}
+        entries = 0
+        with self._file_lock:
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    text = f.read()
+                    inode = os.fstat(f.fileno()).st_ino
+                # La última línea solo está completa si termina en salto de línea
+                text = text[:text.rfind("\n") + 1]
+                for line, kind, job_id in _JOURNAL_LINE_RE.findall(text):
+                    if "\\" in job_id:
+                        job_id = json.loads(f'"{job_id}"')
+                    if kind in JOURNAL_LIVE_EVENTS:
+                        live[job_id] = line
+                    elif kind not in JOURNAL_NOTICE_EVENTS:
+                        live.pop(job_id, None)
+                    entries += 1
+                self._tail_inode, self._tail_offset = inode, len(text.encode('utf-8'))
+
+            # Solo se decodifican por completo los eventos que siguen pendientes
+            events = []
+            for job_id, line in list(live.items()):
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    del live[job_id]
+            with self._cond:
+                self._live = live
+                self._dead = 0
+            if compact:
+                self._compact_file()
+        self.stats.update({
+            "replayed_entries": entries,
+            "replay_ms": round((time.perf_counter() - started) * 1000, 2),
+            "pending_restored": len(events)
+        })
+        return events
+
+    def _compact_file(self):
+        # Se llama con el flock tomado: ningún worker escribe mientras tanto
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.writelines(line + "\n" for line in self._live.values())
+            f.flush()
+            os.fsync(f.fileno())
+            size = f.tell()
+        os.replace(tmp_path, self.path)
+        self._dead = 0
+        self._tail_inode, self._tail_offset = os.stat(self.path).st_ino, size
+
+    def start(self):
+        self._file = open(self.path, 'a', encoding='utf-8')
+        self._thread = threading.Thread(target=self._run, name="job-journal", daemon=True)
+        self._thread.start()
+
+    def append(self, event, wait=False, timeout=1.0):
+        """Añade un evento; con wait=True espera a que esté en disco"""
+        if self._file is None:
+            return
+        done = threading.Event() if wait else None
+        line = json.dumps({**event, "w": self.worker_id}, separators=(',', ':'))
+        with self._cond:
+            self.observe(event, line)
+            self._pending.append((line + "\n", done))
+            self._cond.notify()
+        if done is not None:
+            done.wait(timeout)
+
+    def sync(self, timeout=1.0):
+        """Espera a que esté en disco todo lo añadido hasta ahora (un solo fsync para varios append)"""
+        if self._file is None:
+            return
+        done = threading.Event()
+        with self._cond:
+            self._pending.append(("", done))
+            self._cond.notify()
+        done.wait(timeout)
+
+    def observe(self, event, line=None):
+        """Actualiza el conjunto de trabajos vivos con un evento propio o de otro worker"""
+        with self._cond:
+            if event["e"] in JOURNAL_LIVE_EVENTS:
+                # Una regla se reescribe en cada disparo: la línea anterior queda muerta
+                if self._live.get(event["id"]) is not None:
+                    self._dead += 1
+                self._live[event["id"]] = line or json.dumps(event, separators=(',', ':'))
+            elif event["e"] in JOURNAL_NOTICE_EVENTS:
+                self._dead += 1
+            elif self._live.pop(event["id"], None) is not None:
+                self._dead += 2
+            else:
+                self._dead += 1
+
+    def read_new_events(self):
+        """Eventos escritos por otros workers desde la última lectura.
+
+        Devuelve (eventos, resync): si otro worker ha compactado el diario,
+        resync es True y los eventos son todos los pendientes del fichero nuevo.
+        """
+        with self._file_lock:
+            return self._read_new_events()
+
+    def _read_new_events(self):
+        try:
+            with open(self.path, 'rb') as f:
+                inode = os.fstat(f.fileno()).st_ino
+                resync = inode != self._tail_inode
+                f.seek(0 if resync else self._tail_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return [], False
+        data = data[:data.rfind(b"\n") + 1]
+        self._tail_inode = inode
+        self._tail_offset = len(data) if resync else self._tail_offset + len(data)
+
+        events = []
+        for line in data.decode('utf-8').splitlines():
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if resync or event.get("w") != self.worker_id:
+                events.append(event)
+        return events, resync
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                batch, self._pending = self._pending, []
+            try:
+                with self._file_lock:
+                    self._reopen_if_replaced()
+                    self._file.write("".join(line for line, _ in batch))
+                    self._file.flush()
+                    os.fsync(self._file.fileno())
+                    self.stats["fsyncs"] += 1
+                    self._maybe_compact()
+            except Exception as e:
+                log_message(f"💥 Error escribiendo diario de trabajos: {str(e)}")
+            for _, done in batch:
+                if done is not None:
+                    done.set()
+
+    def _reopen_if_replaced(self):
+        # Otro worker (el líder) puede haber sustituido el fichero al compactar
+        try:
+            current = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            current = None
+        if current != os.fstat(self._file.fileno()).st_ino:
+            self._file.close()
+            self._file = open(self.path, 'a', encoding='utf-8')
+
+    def _maybe_compact(self):
+        # Se llama con el flock tomado; los eventos que lleguen durante la
+        # compactación se escriben después en el fichero nuevo
+        if not self.compaction_enabled:
+            return
+        with self._cond:
+            if self._dead <= max(self.compact_min, len(self._live)):
+                return
+            # Antes de reescribir hay que incorporar lo que hayan añadido otros workers
+            self._file.close()
+            apply_journal_events(*self._read_new_events())
+            self._compact_file()
+            self._file = open(self.path, 'a', encoding='utf-8')
+        self.stats["compactions"] += 1
+
+    def info(self):
+        return {"enabled": self._file is not None, "path": self.path,
+                "live_entries": len(self._live), **self.stats}
+
+job_journal = JobJournal(JOURNAL_PATH)
+
+# ===== PROGRAMACIONES RECURRENTES =====
+
+# Una ocurrencia que tocaba mientras el servicio estaba parado se lanza al
+# volver si no han pasado más de estos segundos
+RECURRING_MISFIRE_GRACE = float(os.getenv('RECURRING_MISFIRE_GRACE', 300))
+
+# Cron estándar numera el día de la semana desde el domingo (0 y 7);
+# APScheduler lo hace desde el lunes, así que los números se pasan a nombres
+CRON_WEEKDAYS = ("sun", "mon", "tue", "wed", "thu", "fri", "sat", "sun")
+DAY_ALIASES = {"daily": "*", "weekdays": "mon-fri", "weekends": "sat,sun"}
+
+def crontab_weekdays(field):
+    """Campo día de la semana de cron en nombres para APScheduler.
+
+    Se traducen los elementos de la lista y los extremos de los rangos, nunca
+    los pasos: un paso (*/2, 1-5/2) se expande a la lista de días que cubre en
+    cron. Un rango con el domingo (0-5, 3-7) se parte en sun + el resto, porque
+    en APScheduler el domingo es el último día y sun-fri no es un rango válido.
+    Lo que no son números (nombres, valores fuera de rango) queda igual para
+    que APScheduler lo valide.
+    """
+    items = []
+    for item in field.split(","):
+        base, slash, step = item.partition("/")
+        if base == "*" and slash:
+            base = "0-6"
+        start, dash, end = base.partition("-")
+        if not (start.isdigit() and (end.isdigit() or not dash) and int(start) <= 7 and int(end or 0) <= 7
+                and (step.isdigit() and int(step) > 0 or not slash)):
+            items.append(item)
+            continue
+        first = int(start)
+        # En cron "a/n" va de a hasta el final de la semana
+        last = int(end) if dash else 6 if slash else first
+        if slash:
+            items.extend(CRON_WEEKDAYS[day] for day in range(first, last + 1, int(step)))
+        elif first > last:
+            items.append(f"{CRON_WEEKDAYS[first]}-{CRON_WEEKDAYS[last]}")
+        else:
+            if first == 0 or last == 7:
+                items.append("sun")
+            first, last = max(first, 1), min(last, 6)
+            if first < last:
+                items.append(f"{CRON_WEEKDAYS[first]}-{CRON_WEEKDAYS[last]}")
+            elif first == last:
+                items.append(CRON_WEEKDAYS[first])
+    return ",".join(dict.fromkeys(items))
+
+def build_trigger(expression):
+    """Disparador cron en hora de España: resuelve los cambios de horario de APScheduler"""
+    from apscheduler.triggers.cron import CronTrigger
+    return CronTrigger.from_crontab(expression, timezone=SPAIN_TZ)
+
+def build_cron_expression(entry):
+    """Convierte {cron} o {days, time} en una expresión cron; devuelve (expresión, error)"""
+    if entry.get('cron'):
+        fields = str(entry['cron']).split()
+        if len(fields) != 5:
+            return None, "cron debe tener 5 campos: minuto hora día mes día_semana"
+        # Cron dispara si coincide cualquiera de los dos; APScheduler exige ambos
+        if fields[2] != "*" and fields[4] != "*":
+            return None, "cron no puede limitar a la vez el día del mes y el día de la semana (crea dos reglas)"
+        fields[4] = crontab_weekdays(fields[4])
+        expression = " ".join(fields)
+    else:
+        match = re.fullmatch(r"(\d{1,2}):(\d{2})", str(entry.get('time', '')))
+        if not match or int(match[1]) > 23 or int(match[2]) > 59:
+            return None, "Indica cron o time (HH:MM) con days opcional"
+        days = entry.get('days', 'daily')
+        if isinstance(days, list):
+            days = ",".join(str(day) for day in days)
+        days = str(days).lower()
+        expression = f"{int(match[2])} {int(match[1])} * * {crontab_weekdays(DAY_ALIASES.get(days, days))}"
+    try:
+        build_trigger(expression)
+    except ValueError as e:
+        return None, f"Programación no válida: {str(e)}"
+    return expression, None
+
+class RecurringRule:
+    """Regla recurrente: solo su próxima ocurrencia vive en el planificador.
+
+    Al dispararse (o cancelarse) la ocurrencia se calcula la siguiente a partir
+    de `last_fire`, así que miles de reglas no cuestan nada entre disparos.
+    """
+
+    __slots__ = ("rule_id", "account", "device_name", "action", "expression",
+                 "last_fire", "trigger", "occurrence_id")
+
+    def __init__(self, rule_id, account, device_name, action, expression, last_fire):
+        self.rule_id = rule_id
+        self.account = account
+        self.device_name = device_name
+        self.action = action
+        self.expression = expression
+        self.last_fire = last_fire
+        self.trigger = build_trigger(expression)
+        self.occurrence_id = None
+
+    @classmethod
+    def from_event(cls, event):
+        return cls(event["id"], event["account"], event["device"], event["action"], event["cron"], event["last"])
+
+    def next_fire(self):
+        """Siguiente disparo posterior al último (o vencido hace menos de RECURRING_MISFIRE_GRACE)"""
+        after = max(self.last_fire + 1, time.time() - RECURRING_MISFIRE_GRACE)
+        fire = self.trigger.get_next_fire_time(None, datetime.fromtimestamp(after, SPAIN_TZ))
+        return SPAIN_TZ.normalize(fire) if fire else None
+
+    def journal_event(self):
+        return {
+            "e": "rule",
+            "id": self.rule_id,
+            "account": self.account,
+            "device": self.device_name,
+            "action": self.action,
+            "cron": self.expression,
+            "last": self.last_fire
+        }
+
+    def to_dict(self):
+        record = job_registry.get(self.occurrence_id) if self.occurrence_id else None
+        return {
+            "id": self.rule_id,
+            "device_name": self.device_name,
+            "action": self.action,
+            "cron": self.expression,
+            "next_job_id": self.occurrence_id,
+            "next_execution_time": record.execution_time if record else None,
+            "last_fire": datetime.fromtimestamp(self.last_fire, SPAIN_TZ).isoformat()
+        }
+
+recurring_rules = {}
+recurring_rules_lock = threading.RLock()
+
+def schedule_rule_occurrence(rule):
+    """Da de alta la próxima ocurrencia de la regla como un trabajo normal (no va al diario)"""
+    fire = rule.next_fire()
+    if fire is None:
+        rule.occurrence_id = None
+        return None
+    rule.occurrence_id = f"{rule.rule_id}_{fire.strftime('%Y%m%d_%H%M')}"
+    password = account_password(rule.account)
+    schedule_job(rule.occurrence_id, rule.account, password, rule.device_name, rule.action,
+                 datetime.now(SPAIN_TZ), fire, persist=False, rule_id=rule.rule_id)
+    return fire
+
+def drop_rule_occurrence(rule):
+    if rule.occurrence_id:
+        scheduler.cancel(rule.occurrence_id)
+        job_registry.remove(rule.occurrence_id)
+
+def add_recurring_rule(rule, persist=True):
+    """Alta (o sustitución) de una regla y de su próxima ocurrencia"""
+    if scheduler_leadership.is_leader and account_password(rule.account) is None:
+        log_message(f"⚠️ [{rule.rule_id}] Sin credenciales para {rule.account}, la regla no se programa")
+        return None
+    with recurring_rules_lock:
+        previous = recurring_rules.get(rule.rule_id)
+        if previous is not None:
+            drop_rule_occurrence(previous)
+        recurring_rules[rule.rule_id] = rule
+        if persist:
+            job_journal.append(rule.journal_event(), wait=True)
+        return schedule_rule_occurrence(rule)
+
+def remove_recurring_rule(rule_id, persist=True):
+    with recurring_rules_lock:
+        rule = recurring_rules.pop(rule_id, None)
+        if rule is not None:
+            drop_rule_occurrence(rule)
+            if persist:
+                job_journal.append({"e": "cancel", "id": rule_id})
+        return rule
+
+def advance_recurring_rule(rule_id, due):
+    """La ocurrencia que vencía en `due` se ha disparado o cancelado: se programa la siguiente"""
+    with recurring_rules_lock:
+        rule = recurring_rules.get(rule_id)
+        # Un trabajo aplazado vuelve a pasar por aquí: solo avanza la primera vez
+        if rule is None or due <= rule.last_fire:
+            return
+        rule.last_fire = due
+        job_journal.append(rule.journal_event())
+        fire = schedule_rule_occurrence(rule)
+    if fire is not None:
+        log_message(f"🔁 [{rule_id}] Próxima ejecución: {fire.strftime('%H:%M:%S %d/%m/%Y %Z')}",
+                    job_id=rule.occurrence_id, device=rule.device_name, phase="scheduled")
+
+# ===== ESCENAS =====
+
+# Comandos simultáneos al ejecutar una escena, espera máxima de
+# /scenes/<nombre>/run (segundos) y dispositivos por escena
+SCENE_CONCURRENCY = int(os.getenv('SCENE_CONCURRENCY', 8))
+SCENE_RUN_TIMEOUT = float(os.getenv('SCENE_RUN_TIMEOUT', 60))
+MAX_SCENE_DEVICES = 50
+# En el diario las escenas llevan este prefijo para no chocar con ids de trabajos
+SCENE_ID_PREFIX = "scene:"
+
+class Scene:
+    """Acciones con nombre (dispositivo -> on/off) que se ejecutan a la vez"""
+
+    __slots__ = ("name", "account", "actions", "created")
+
+    def __init__(self, name, account, actions, created):
+        self.name = name
+        self.account = account
+        self.actions = actions  # [(dispositivo, acción)]
+        self.created = created
+
+    @classmethod
+    def from_event(cls, event):
+        return cls(event["name"], event["account"],
+                   [(entry["device"], entry["action"]) for entry in event["actions"]], event["created"])
+
+    def journal_event(self):
+        return {
+            "e": "scene", "id": f"{SCENE_ID_PREFIX}{self.name}", "name": self.name, "account": self.account,
+            "actions": [{"device": device, "action": action} for device, action in self.actions],
+            "created": self.created
+        }
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "devices": [{"device_name": device, "action": action} for device, action in self.actions],
+            "created": datetime.fromtimestamp(self.created, SPAIN_TZ).isoformat()
+        }
+
+scenes = {}  # nombre -> Scene
+scenes_lock = threading.RLock()
+
+def parse_scene_actions(entries):
+    """Valida [{device_name, action}, ...]; devuelve (acciones, error)"""
+    if not isinstance(entries, list) or not entries:
+        return None, "devices debe ser una lista no vacía"
+    if len(entries) > MAX_SCENE_DEVICES:
+        return None, f"Máximo {MAX_SCENE_DEVICES} dispositivos por escena"
+    actions = []
+    for entry in entries:
+        entry = entry if isinstance(entry, dict) else {}
+        device_name = entry.get('device_name')
+        action = str(entry.get('action', 'off')).lower()
+        if not device_name:
+            return None, "Cada dispositivo necesita device_name"
+        if action not in ('on', 'off'):
+            return None, f"Acción '{action}' no válida (usar 'on' u 'off')"
+        if any(device_name == known for known, _ in actions):
+            return None, f"Dispositivo '{device_name}' repetido en la escena"
+        actions.append((device_name, action))
+    return actions, None
+
+def add_scene(scene, persist=True):
+    """Alta o sustitución de una escena"""
+    with scenes_lock:
+        scenes[scene.name] = scene
+        if persist:
+            job_journal.append(scene.journal_event(), wait=True)
+
+def remove_scene(name, persist=True):
+    with scenes_lock:
+        scene = scenes.pop(name, None)
+        if scene is not None and persist:
+            job_journal.append({"e": "cancel", "id": f"{SCENE_ID_PREFIX}{name}"})
+        return scene
+
+async def run_scene(email, password, scene, run_id):
+    """Ejecuta las acciones de la escena en paralelo (como mucho SCENE_CONCURRENCY a la vez).
+
+    Todas comparten la sesión, el descubrimiento y la caché de estados; cada
+    dispositivo devuelve su propio resultado y un fallo no frena al resto.
+    """
+    semaphore = asyncio.Semaphore(SCENE_CONCURRENCY)
+
+    async def run_action(device_name, action):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                result = await control_device_meross_iot(email, password, device_name, action,
+                                                         f"{run_id}_{device_name}")
+            except CircuitOpenError as e:
+                result = {"status": "error", "message": f"Nube Meross no disponible: {str(e)}"}
+            except Exception as e:
+                result = {"status": "error", "message": str(e)}
+            return {"device_name": device_name, "action": action, **result,
+                    "duration_ms": round((time.perf_counter() - started) * 1000, 1)}
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(run_action(device, action) for device, action in scene.actions))
+    return results, record_phase("scene", started)
+
+# ===== PLANIFICADOR =====
+
+# Trabajos que vencen dentro de esta ventana (segundos) se ejecutan en un mismo lote
+COALESCE_WINDOW = float(os.getenv('SCHEDULER_COALESCE_WINDOW', 1.0))
+
+# Preparación anticipada: los trabajos salen del planificador antes de vencer
+# para conectar, resolver el dispositivo y leer su estado, y el comando se
+# envía justo al vencer. La antelación sigue a la latencia de preparación
+# medida, acotada entre PREWARM_MIN_LEAD y PREWARM_MAX_LEAD segundos.
+PREWARM_ENABLED = os.getenv('PREWARM_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+PREWARM_MIN_LEAD = float(os.getenv('PREWARM_MIN_LEAD', 0.5))
+PREWARM_MAX_LEAD = float(os.getenv('PREWARM_MAX_LEAD', 30))
+# Antelación en frío (sin sesión o sin descubrimiento) hasta tener medidas
+PREWARM_COLD_LEAD = float(os.getenv('PREWARM_COLD_LEAD', 15))
+
+class PrepareLatency:
+    """Media y desviación móviles (EWMA) del tiempo de preparación.
+
+    Se lleva por separado en frío (hay que hacer login o descubrir) y en
+    caliente; la antelación es media + 4 desviaciones, con un margen fijo.
+    """
+
+    def __init__(self, alpha=0.2, margin=0.1):
+        self.alpha = alpha
+        self.margin = margin
+        self._stats = {}  # "warm" | "cold" -> (media, desviación) en segundos
+
+    def observe(self, kind, seconds):
+        stats = self._stats.get(kind)
+        if stats is None:
+            self._stats[kind] = (seconds, seconds / 2)
+            return
+        mean, deviation = stats
+        deviation += self.alpha * (abs(seconds - mean) - deviation)
+        mean += self.alpha * (seconds - mean)
+        self._stats[kind] = (mean, deviation)
+
+    def lead(self, kind):
+        stats = self._stats.get(kind)
+        if stats is None:
+            estimate = PREWARM_COLD_LEAD if kind == "cold" else PREWARM_MIN_LEAD
+        else:
+            estimate = stats[0] + 4 * stats[1] + self.margin
+        return min(PREWARM_MAX_LEAD, max(PREWARM_MIN_LEAD, estimate))
+
+    def current_lead(self):
+        """Antelación para la próxima preparación según el estado de las sesiones"""
+        if not PREWARM_ENABLED:
+            return 0
+        with meross_sessions_lock:
+            sessions = list(meross_sessions.values())
+        warm = bool(sessions) and all(session.connected and session.devices.is_loaded() for session in sessions)
+        return self.lead("warm" if warm else "cold")
+
+    def info(self):
+        return {
+            "enabled": PREWARM_ENABLED,
+            "lead_seconds": round(self.current_lead(), 3),
+            **{f"{kind}_mean_ms": round(mean * 1000, 1) for kind, (mean, _) in list(self._stats.items())}
+        }
+
+prepare_latency = PrepareLatency()
+
+class TimerScheduler:
+    """Planificador único: un solo hilo y un min-heap ordenado por instante monotónico.
+
+    Cada trabajo pendiente cuesta una tupla en el heap y una entrada en el
+    diccionario; cancelar elimina la entrada al momento y deja una marca en el
+    heap que se descarta al llegar a la cima (o al compactar). Los trabajos que
+    vencen dentro de `coalesce_window` se entregan juntos a `dispatch`. Con
+    `lead` (función que devuelve segundos) se entregan con esa antelación,
+    salvo los programados con lead=False (los aplazados, que no se preparan).
+    """
+
+    # Con antelación variable se revisa cada tanto por si ha crecido
+    lead_recheck = 5.0
+
+    def __init__(self, dispatch, coalesce_window=COALESCE_WINDOW, lead=None):
+        self._dispatch = dispatch
+        self.coalesce_window = coalesce_window
+        self._lead = lead
+        self._heap = []          # (vencimiento monotónico, secuencia, job_id)
+        self._entries = {}       # job_id -> (secuencia, datos del trabajo, con antelación)
+        self._cancelled = 0
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="timer-scheduler", daemon=True)
+        self._thread.start()
+
+    def schedule(self, job_id, delay_seconds, payload, lead=True):
+        """Programa el trabajo dentro de delay_seconds; reemplaza un job_id existente"""
+        due = time.monotonic() + max(0, delay_seconds)
+        with self._cond:
+            if job_id in self._entries:
+                self._cancelled += 1
+            seq = next(self._seq)
+            self._entries[job_id] = (seq, payload, lead)
+            heapq.heappush(self._heap, (due, seq, job_id))
+            # Solo hace falta despertar al hilo si el nuevo trabajo es el más próximo
+            if self._heap[0][1] == seq:
+                self._cond.notify()
+        return due
+
+    def cancel(self, job_id):
+        """Cancela un trabajo pendiente; devuelve False si ya no estaba programado"""
+        with self._cond:
+            if self._entries.pop(job_id, None) is None:
+                return False
+            self._cancelled += 1
+            if self._cancelled > 64 and self._cancelled > len(self._heap) // 2:
+                self._compact()
+            return True
+
+    def pending_count(self):
+        return len(self._entries)
+
+    def is_alive(self):
+        return self._thread.is_alive()
+
+    def _compact(self):
+        # Reconstruye el heap sin las marcas de trabajos cancelados: O(n)
+        self._heap = [item for item in self._heap
+                      if self._entries.get(item[2], (None,))[0] == item[1]]
+        heapq.heapify(self._heap)
+        self._cancelled = 0
+
+    def _pop_live(self):
+        """Saca la cima del heap; devuelve (job_id, datos) o None si estaba cancelada"""
+        due, seq, job_id = heapq.heappop(self._heap)
+        entry = self._entries.get(job_id)
+        if entry is None or entry[0] != seq:
+            self._cancelled = max(0, self._cancelled - 1)
+            return None
+        del self._entries[job_id]
+        return job_id, entry[1]
+
+    def _pop_due(self):
+        """Espera a que venza el siguiente trabajo y devuelve el lote que vence con él"""
+        with self._cond:
+            while True:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                due, seq, job_id = self._heap[0]
+                entry = self._entries.get(job_id)
+                if entry is None or entry[0] != seq:
+                    self._pop_live()
+                    continue
+                now = time.monotonic()
+                lead = self._lead() if self._lead and entry[2] else 0
+                if due - lead > now:
+                    remaining = due - lead - now
+                    self._cond.wait(min(remaining, self.lead_recheck) if lead else remaining)
+                    continue
+
+                batch = [self._pop_live()]
+                horizon = now + lead + self.coalesce_window
+                while self._heap and self._heap[0][0] <= horizon:
+                    item = self._pop_live()
+                    if item is not None:
+                        batch.append(item)
+                return batch
+
+    def _run(self):
+        while True:
+            batch = self._pop_due()
+            try:
+                self._dispatch(batch)
+            except Exception as e:
+                log_message(f"💥 Error lanzando lote de {len(batch)} trabajos: {str(e)}")
+
+# Lock que decide qué worker es dueño del planificador y cada cuánto lo
+# reintentan los demás por si el líder muere (segundos)
+SCHEDULER_LOCK_PATH = os.getenv('SCHEDULER_LOCK_PATH', 'scheduler.lock')
+SCHEDULER_LEADER_RETRY = float(os.getenv('SCHEDULER_LEADER_RETRY', 5))
+
+class SchedulerLeadership:
+    """Elección de líder entre workers: el que consigue el flock planifica.
 
-app = Flask(__name__)
+    El lock se libera solo cuando el proceso muere, así que nunca hay dos
+    planificadores disparando a la vez; los seguidores vuelven a intentarlo
+    periódicamente para tomar el relevo.
+    """
 
-# Configurar timezone de España
-SPAIN_TZ = pytz.timezone('Europe/Madrid')
+    def __init__(self, path):
+        self.is_leader = False
+        self._lock = FileLock(path) if path else None
 
-# Diccionario para trackear tareas activas
-active_tasks = {}
+    def try_acquire(self):
+        if not self.is_leader:
+            self.is_leader = self._lock is None or self._lock.acquire(blocking=False)
+        return self.is_leader
 
-def log_message(message):
-    timestamp = datetime.now(SPAIN_TZ).strftime("%Y-%m-%d %H:%M:%S %Z")
-    print(f"[{timestamp}] {message}", flush=True)
+    def info(self):
+        return {"pid": os.getpid(), "scheduler_leader": self.is_leader}
 
-async def control_device_meross_iot(email, password, device_name, action, job_id, max_retries=3):
-    """Control usando meross-iot (la librería que sabemos que funciona)"""
-    for attempt in range(max_retries):
-        http_api_client = None
-        manager = None
-        
-        try:
-            log_message(f"🔧 [{job_id}] Intento {attempt + 1}/{max_retries} - Controlando {device_name} -> {action}")
-            
-            # Conectar con meross-iot - API corregida para v0.4.9.0
-            http_api_client = await MerossHttpClient.async_from_user_password(
-                api_base_url='https://iotx-eu.meross.com',
-                email=email, 
-                password=password
-            )
-            log_message(f"✅ [{job_id}] Login exitoso con meross-iot")
-            
-            # Manager
-            manager = MerossManager(http_client=http_api_client)
-            await manager.async_init()
-            log_message(f"✅ [{job_id}] Manager inicializado")
+def schedule_delayed_task(email, password, device_name, action, minutes, job_id, durable=True):
+    """Registra el trabajo, lo anota en el diario y lo programa (no bloquea)"""
+    start_time = datetime.now(SPAIN_TZ)
+    execution_time = start_time + timedelta(minutes=minutes)
+    schedule_job(job_id, email, password, device_name, action, start_time, execution_time, durable=durable)
+    log_message(f"⏰ [{job_id}] Esperando {minutes} minutos...",
+                job_id=job_id, device=device_name, phase="scheduled")
+    log_message(f"🕐 [{job_id}] Se ejecutará a las: {execution_time.strftime('%H:%M:%S')}",
+                job_id=job_id, device=device_name, phase="scheduled")
+    return execution_time
 
-            # Descubrir dispositivos
-            await manager.async_device_discovery()
-            devices = manager.find_devices(device_name=device_name)
-            
-            if not devices:
-                all_devices = manager.find_devices()
-                available = [d.name for d in all_devices]
-                return {
-                    "status": "error", 
-                    "message": f"Dispositivo '{device_name}' no encontrado. Disponibles: {available}"
-                }
-                
-            device = devices[0]
-            log_message(f"✅ [{job_id}] Dispositivo encontrado: {device.name}")
-            
-            # Actualizar estado del dispositivo
-            await device.async_update()
-            current_state = device.is_on()
-            log_message(f"📊 [{job_id}] Estado actual: {'🟢 ENCENDIDO' if current_state else '🔴 APAGADO'}")
-            
-            # Ejecutar acción
-            if action.lower() == 'off':
-                await device.async_turn_off()
-                log_message(f"🔌 [{job_id}] {device.name} APAGADO")
-            elif action.lower() == 'on':
-                await device.async_turn_on()
-                log_message(f"🔌 [{job_id}] {device.name} ENCENDIDO")
-            
-            # Verificar resultado
-            await asyncio.sleep(2)
-            await device.async_update()
-            new_state = device.is_on()
-            log_message(f"✅ [{job_id}] Nuevo estado: {'🟢 ENCENDIDO' if new_state else '🔴 APAGADO'}")
-            
+# Qué hacer con un temporizador pendiente del mismo dispositivo y acción:
+#   replace        el nuevo sustituye a los pendientes
+#   keep_earliest  se queda el que vence antes
+#   keep_latest    se queda el que vence después
+#   stack          se programan todos, como antes
+CONFLICT_POLICIES = ("replace", "keep_earliest", "keep_latest", "stack")
+TIMER_CONFLICT_POLICY = os.getenv('TIMER_CONFLICT_POLICY', 'replace')
+# Política por dispositivo, p. ej. {"KodiPlex": "keep_earliest"}
+DEVICE_CONFLICT_POLICIES = json.loads(os.getenv('DEVICE_CONFLICT_POLICIES') or '{}')
+
+device_schedule_locks = {}
+device_schedule_locks_lock = threading.Lock()
+
+def new_job_id(device_name, action):
+    """Id legible y único: el segundo no basta entre peticiones simultáneas ni entre workers"""
+    now = datetime.now(SPAIN_TZ)
+    return f"{device_name}_{action}_{now.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
+
+def conflict_policy_for(device_name, requested=None):
+    return requested or DEVICE_CONFLICT_POLICIES.get(device_name, TIMER_CONFLICT_POLICY)
+
+def schedule_timer(email, password, device_name, action, minutes, policy=None, durable=True):
+    """Programa un temporizador resolviendo antes los conflictos con los pendientes del dispositivo.
+
+    Devuelve {job_id, execution_time, policy, superseded, deduplicated}: con
+    deduplicated=True no se programa nada y job_id es el trabajo que se mantiene.
+    Con durable=False no espera al fsync del diario (quien llama hace sync()).
+    """
+    policy = conflict_policy_for(device_name, policy)
+    with device_schedule_locks_lock:
+        device_lock = device_schedule_locks.setdefault((email, device_name), threading.Lock())
+
+    # El lock es por dispositivo: dispositivos distintos se programan en paralelo
+    with device_lock:
+        due = time.time() + minutes * 60
+        pending = [] if policy == "stack" else job_registry.pending_for(device_name, action, account_name(email))
+        if policy == "keep_earliest":
+            kept = min((r for r in pending if r.due <= due), key=lambda r: r.due, default=None)
+        elif policy == "keep_latest":
+            kept = max((r for r in pending if r.due >= due), key=lambda r: r.due, default=None)
+        else:
+            kept = None
+
+        if kept is not None:
+            TIMER_CONFLICTS.inc("deduplicated")
+            log_message(f"♻️ [{kept.job_id}] Ya programado {device_name} -> {action}: se descarta el nuevo ({policy})",
+                        job_id=kept.job_id, device=device_name, phase="deduplicated")
             return {
-                "status": "success", 
-                "message": f"Acción '{action}' ejecutada en {device.name}",
-                "previous_state": "on" if current_state else "off",
-                "new_state": "on" if new_state else "off"
+                "job_id": kept.job_id,
+                "execution_time": datetime.fromtimestamp(kept.due, SPAIN_TZ),
+                "policy": policy,
+                "superseded": [],
+                "deduplicated": True
             }
-            
-        except Exception as e:
-            log_message(f"💥 [{job_id}] Error en intento {attempt + 1}: {str(e)}")
-            if attempt < max_retries - 1:
-                wait_time = (attempt + 1) * 15
-                log_message(f"⏳ [{job_id}] Esperando {wait_time} segundos antes del siguiente intento...")
-                await asyncio.sleep(wait_time)
-            else:
-                return {"status": "error", "message": f"Error después de {max_retries} intentos: {str(e)}"}
-                
-        finally:
-            if manager:
-                manager.close()
-            if http_api_client:
-                await http_api_client.async_logout()
 
-def execute_delayed_task(email, password, device_name, action, minutes, job_id):
-    """Función que se ejecuta en un hilo separado con sleep"""
-    try:
-        # Marcar como activa
-        start_time = datetime.now(SPAIN_TZ)
-        execution_time = start_time + timedelta(minutes=minutes)
-        active_tasks[job_id] = {
-            "device_name": device_name,
+        superseded = [record.job_id for record in pending]
+        for job_id in superseded:
+            cancel_job_entry(job_id, reason=f"superseded:{policy}")
+            TIMER_CONFLICTS.inc("superseded")
+            log_message(f"🔁 [{job_id}] Sustituido por un temporizador nuevo ({policy})",
+                        job_id=job_id, device=device_name, phase="superseded")
+
+        job_id = new_job_id(device_name, action)
+        execution_time = schedule_delayed_task(email, password, device_name, action, minutes, job_id, durable)
+    return {
+        "job_id": job_id,
+        "execution_time": execution_time,
+        "policy": policy,
+        "superseded": superseded,
+        "deduplicated": False
+    }
+
+def schedule_job(job_id, email, password, device_name, action, start_time, execution_time, persist=True,
+                 rule_id=None, durable=True):
+    """Alta de un trabajo con instante absoluto de ejecución"""
+    job_registry.add(JobRecord(job_id, device_name, action, start_time.timestamp(), execution_time.timestamp(),
+                               rule_id=rule_id, account=account_name(email)))
+
+    if persist:
+        job_events.publish("scheduled", job_id, device=device_name, action=action,
+                           execution_time=execution_time.isoformat())
+        # La contraseña nunca se escribe en disco: se resuelve al restaurar
+        job_journal.append({
+            "e": "schedule",
+            "id": job_id,
+            "account": email,
+            "device": device_name,
             "action": action,
-            "start_time": start_time.isoformat(),
-            "execution_time": execution_time.isoformat(),
-            "status": "waiting"
-        }
-        
-        log_message(f"⏰ [{job_id}] Esperando {minutes} minutos...")
-        log_message(f"🕐 [{job_id}] Se ejecutará a las: {execution_time.strftime('%H:%M:%S')}")
-        
-        # SLEEP - aquí es donde pausamos
-        if minutes > 0:
-            time.sleep(minutes * 60)
-        
-        # Verificar si la tarea fue cancelada durante el sleep
-        if job_id not in active_tasks:
-            log_message(f"❌ [{job_id}] Tarea cancelada durante la espera")
-            return
-        
-        # Actualizar estado
-        active_tasks[job_id]["status"] = "executing"
-        log_message(f"🚀 [{job_id}] ¡Tiempo cumplido! Ejecutando acción...")
-        
-        # Ejecutar la acción con meross-iot
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+            "start": start_time.timestamp(),
+            "due": execution_time.timestamp()
+        }, wait=durable)
+
+    # Solo el worker líder programa; los demás dejan el trabajo en el diario
+    if not scheduler_leadership.is_leader:
+        return
+
+    # Los instantes de pared se convierten a demora monotónica
+    delay = execution_time.timestamp() - time.time()
+    scheduler.schedule(job_id, delay, {
+        "email": email,
+        "password": password,
+        "device_name": device_name,
+        "action": action,
+        "rule_id": rule_id
+    })
+
+def set_job_status(job_id, status, deferred_until=None, **fields):
+    """Cambia el estado de un trabajo, lo publica y lo avisa en el diario a los seguidores"""
+    record = job_registry.set_status(job_id, status, deferred_until=deferred_until)
+    if record is None:
+        return None
+    job_journal.append({"e": "status", "id": job_id, "status": status,
+                        "deferred_until": deferred_until, "fields": fields})
+    job_events.publish(status, job_id, **fields)
+    return record
+
+# Estados en los que el trabajo aún no ha tocado el dispositivo
+CANCELLABLE_STATUSES = ("waiting", "deferred", "preparing")
+
+def cancel_job_entry(job_id, reason=None):
+    """Cancela un trabajo pendiente en memoria, en el planificador y en el diario"""
+    scheduler.cancel(job_id)
+    record = job_registry.remove(job_id)
+    job_journal.append({"e": "cancel", "id": job_id})
+    job_events.publish("cancelled", job_id, device=record.device_name if record else None, reason=reason)
+    # Cancelar una ocurrencia salta solo esa: la regla sigue con la siguiente
+    if record is not None and record.rule_id is not None:
+        advance_recurring_rule(record.rule_id, record.due)
+
+def restore_job(event):
+    """Programa en este worker un trabajo leído del diario (vencido = se lanza ya)"""
+    password = account_password(event["account"])
+    if password is None:
+        log_message(f"⚠️ [{event['id']}] Sin credenciales para {event['account']}, se descarta")
+        cancel_job_entry(event["id"])
+        return False
+    schedule_job(
+        event["id"], event["account"], password, event["device"], event["action"],
+        datetime.fromtimestamp(event["start"], SPAIN_TZ),
+        datetime.fromtimestamp(event["due"], SPAIN_TZ),
+        persist=False
+    )
+    return True
+
+def register_job_view(event):
+    """En un worker seguidor solo se refleja el trabajo para /jobs: no se programa"""
+    job_registry.add(JobRecord(event["id"], event["device"], event["action"], event["start"], event["due"],
+                               account=account_name(event["account"])))
+
+def apply_journal_events(events, resync=False):
+    """Aplica en este worker los eventos que otros workers han escrito en el diario"""
+    if resync:
+        # El líder ha compactado: los eventos son todos los pendientes
+        job_registry.clear()
+        with recurring_rules_lock:
+            recurring_rules.clear()
+        with scenes_lock:
+            scenes.clear()
+    for event in events:
+        job_journal.observe(event)
+        if event["e"] == "status":
+            if job_registry.set_status(event["id"], event["status"], event.get("deferred_until")) is not None:
+                job_events.publish(event["status"], event["id"], **event.get("fields", {}))
+        elif event["e"] == "cancel_request":
+            # Solo el líder decide: un trabajo que ya se está ejecutando no se cancela
+            if scheduler_leadership.is_leader:
+                record = job_registry.get(event["id"])
+                if record is not None and record.status in CANCELLABLE_STATUSES:
+                    cancel_job_entry(event["id"])
+                    log_message(f"✅ Job cancelado a petición de otro worker: {event['id']}")
+                elif record is not None:
+                    log_message(f"⚠️ [{event['id']}] Cancelación rechazada: estado '{record.status}'")
+        elif event["e"] == "rule":
+            add_recurring_rule(RecurringRule.from_event(event), persist=False)
+        elif event["id"] in recurring_rules:
+            remove_recurring_rule(event["id"], persist=False)
+        elif event["e"] == "scene":
+            add_scene(Scene.from_event(event), persist=False)
+        elif event["id"].startswith(SCENE_ID_PREFIX):
+            remove_scene(event["id"][len(SCENE_ID_PREFIX):], persist=False)
+        elif event["e"] == "schedule":
+            if scheduler_leadership.is_leader:
+                restore_job(event)
+            else:
+                register_job_view(event)
+            # Tras una compactación llegan todos los pendientes, no novedades
+            if not resync:
+                job_events.publish("scheduled", event["id"], device=event["device"], action=event["action"],
+                                   execution_time=datetime.fromtimestamp(event["due"], SPAIN_TZ).isoformat())
+        else:
+            scheduler.cancel(event["id"])
+            record = job_registry.remove(event["id"])
+            device = record.device_name if record else None
+            if event["e"] == "cancel":
+                job_events.publish("cancelled", event["id"], device=device)
+            else:
+                publish_job_result(event["id"], event.get("result") or {"status": event.get("status")}, device)
+
+def become_scheduler_leader():
+    """Reproduce y compacta el diario y programa todos los trabajos pendientes"""
+    job_journal.compaction_enabled = True
+    events = job_journal.replay(compact=True)
+    job_registry.clear()
+    with recurring_rules_lock:
+        recurring_rules.clear()
+    rules = [event for event in events if event["e"] == "rule"]
+    jobs = [event for event in events if event["e"] == "schedule"]
+    with scenes_lock:
+        scenes.clear()
+        for event in events:
+            if event["e"] == "scene":
+                add_scene(Scene.from_event(event), persist=False)
+    overdue = sum(1 for event in jobs if event["due"] <= time.time())
+    for event in jobs:
+        restore_job(event)
+    for event in rules:
+        add_recurring_rule(RecurringRule.from_event(event), persist=False)
+
+    stats = job_journal.info()
+    log_message(f"📒 Diario restaurado: {len(jobs)} pendientes ({overdue} vencidos), {len(rules)} reglas "
+                f"y {len(scenes)} escenas de {stats['replayed_entries']} entradas en {stats['replay_ms']} ms")
+
+def follow_journal():
+    """Hilo de cada worker: incorpora eventos ajenos y opta al liderazgo si queda libre"""
+    last_attempt = time.monotonic()
+    while True:
+        time.sleep(JOURNAL_TAIL_INTERVAL)
         try:
-            result = loop.run_until_complete(
-                control_device_meross_iot(email, password, device_name, action, job_id)
-            )
-            log_message(f"🎯 [{job_id}] Resultado: {result}")
-        finally:
-            loop.close()
-        
-        # LIMPIAR INMEDIATAMENTE después de ejecutar
-        if job_id in active_tasks:
-            log_message(f"🧹 [{job_id}] Limpiando trabajo completado")
-            del active_tasks[job_id]
-            log_message(f"✅ [{job_id}] Trabajo eliminado de memoria")
-        
+            if (not scheduler_leadership.is_leader
+                    and time.monotonic() - last_attempt >= SCHEDULER_LEADER_RETRY):
+                last_attempt = time.monotonic()
+                if scheduler_leadership.try_acquire():
+                    log_message(f"👑 Worker {os.getpid()} asume el planificador")
+                    become_scheduler_leader()
+                    continue
+            apply_journal_events(*job_journal.read_new_events())
+        except Exception as e:
+            log_message(f"💥 Error siguiendo el diario de trabajos: {str(e)}")
+
+def start_job_service():
+    """Arranque del servicio de trabajos: liderazgo, diario y restauración"""
+    if not JOURNAL_PATH:
+        # Sin diario compartido cada proceso planifica solo sus propios trabajos
+        scheduler_leadership.is_leader = True
+        return
+    try:
+        if scheduler_leadership.try_acquire():
+            become_scheduler_leader()
+        else:
+            log_message(f"👥 Worker {os.getpid()} en modo seguidor: otro worker tiene el planificador")
+            for event in job_journal.replay(compact=False):
+                if event["e"] == "rule":
+                    add_recurring_rule(RecurringRule.from_event(event), persist=False)
+                elif event["e"] == "scene":
+                    add_scene(Scene.from_event(event), persist=False)
+                else:
+                    register_job_view(event)
+        job_journal.start()
+    except Exception as e:
+        log_message(f"💥 Error restaurando el diario de trabajos: {str(e)}")
+        return
+    threading.Thread(target=follow_journal, name="journal-follower", daemon=True).start()
+
+def dispatch_due_jobs(batch):
+    """Se ejecuta en el hilo del planificador: agrupa el lote por cuenta y lo lanza sin bloquear"""
+    groups = {}
+    for job_id, job in batch:
+        # Verificar si la tarea fue cancelada mientras esperaba
+        record = job_registry.get(job_id)
+        if record is None:
+            log_message(f"❌ [{job_id}] Tarea cancelada durante la espera", job_id=job_id, phase="cancelled")
+            continue
+        # Las reglas recurrentes dejan programada su siguiente ocurrencia al disparar
+        if job.get("rule_id"):
+            advance_recurring_rule(job["rule_id"], record.due)
+        # Un aplazado sale en cuanto se puede; el resto, a su hora exacta
+        job["fire_at"] = record.due if record.status != "deferred" else None
+        groups.setdefault((job["email"], job["password"]), []).append((job_id, job))
+
+    for (email, password), jobs in groups.items():
+        session = get_meross_session(email, password)
+        # Con el circuito abierto los trabajos se aplazan sin tocar la nube, y
+        # mientras una prueba está en curso esperan a su resultado; los que
+        # van por la LAN no dependen de la nube y salen igualmente
+        circuit_open = session.breaker.state == "open"
+        ready, deferred = [], []
+        for job_id, job in jobs:
+            if session.breaker_for(job["device_name"]) is LAN_BREAKER:
+                ready.append((job_id, job))
+            elif circuit_open:
+                deferred.append((job_id, job))
+            elif not park_job(session, job_id, job):
+                ready.append((job_id, job))
+        if deferred:
+            defer_jobs(session, deferred, session.breaker.retry_after())
+        jobs = ready
+        if not jobs:
+            continue
+        for job_id, job in jobs:
+            set_job_status(job_id, "preparing", device=job["device_name"], action=job["action"])
+            log_message(f"🛫 [{job_id}] Preparando ejecución...",
+                        job_id=job_id, device=job["device_name"], phase="prepare")
+        if len(jobs) > 1:
+            log_message(f"📦 Lote de {len(jobs)} trabajos: {', '.join(job_id for job_id, _ in jobs)}")
+        session.submit(execute_job_batch(email, password, jobs))
+
+def defer_jobs(session, jobs, retry_after):
+    """Vuelve a programar trabajos mientras la nube falla, uno por hueco de drenaje de la sesión"""
+    for job_id, job in jobs:
+        if job_id not in job_registry:
+            continue
+        delay = session.breaker.drain_delay(retry_after)
+        set_job_status(job_id, "deferred", deferred_until=time.time() + delay, retry_in_seconds=round(delay, 1))
+        JOBS_DEFERRED.inc()
+        # Sin antelación: si volviera a salir antes de retry_after encontraría el
+        # circuito aún abierto y se aplazaría una y otra vez
+        scheduler.schedule(job_id, delay, job, lead=False)
+        log_message(f"⏸️ [{job_id}] Nube Meross no disponible, aplazado {delay:.1f}s",
+                    job_id=job_id, device=job["device_name"], phase="deferred")
+
+def park_job(session, job_id, job):
+    """Deja el trabajo esperando a la prueba del circuito en curso; False si no hay prueba"""
+    if not session.breaker.park((job_id, job)):
+        return False
+    if set_job_status(job_id, "deferred", waiting_for="probe") is not None:
+        JOBS_DEFERRED.inc()
+        log_message(f"⏸️ [{job_id}] Esperando a la prueba de la nube Meross",
+                    job_id=job_id, device=job["device_name"], phase="deferred")
+    return True
+
+async def execute_job_batch(email, password, jobs):
+    """Ejecuta un lote en la sesión compartida con los comandos en paralelo.
+
+    Cada trabajo informa de su propio resultado en cuanto termina, sin esperar
+    al resto del lote.
+    """
+    await asyncio.gather(*(
+        execute_batched_job(email, password, job_id, job) for job_id, job in jobs
+    ))
+
+def fire_job(job_id, job):
+    """Marca el trabajo como en ejecución al llegar su instante; False si se canceló mientras se preparaba"""
+    record = set_job_status(job_id, "executing", device=job["device_name"], action=job["action"])
+    if record is None:
+        return False
+    LATENESS_SECONDS.observe(time.time() - record.due)
+    log_message(f"🚀 [{job_id}] ¡Tiempo cumplido! Ejecutando acción...",
+                job_id=job_id, device=job["device_name"], phase="fire")
+    return True
+
+async def execute_batched_job(email, password, job_id, job):
+    try:
+        result = await control_device_meross_iot(
+            email, password, job["device_name"], job["action"], job_id,
+            fire_at=job.get("fire_at"), on_fire=lambda: fire_job(job_id, job)
+        )
+    except CircuitOpenError as e:
+        session = get_meross_session(email, password)
+        if not (e.probing and park_job(session, job_id, job)):
+            defer_jobs(session, [(job_id, job)], e.retry_after)
+        return None
     except Exception as e:
-        log_message(f"💥 [{job_id}] Error crítico: {str(e)}")
-        # Limpiar también los trabajos con error
-        if job_id in active_tasks:
-            log_message(f"🧹 [{job_id}] Limpiando trabajo con error")
-            del active_tasks[job_id]
+        log_message(f"💥 [{job_id}] Error crítico: {str(e)}", job_id=job_id, phase="error")
+        result = {"status": "error", "message": str(e)}
+    if result.get("status") == "cancelled":
+        # cancel_job_entry ya lo ha anotado y publicado
+        log_message(f"❌ [{job_id}] Tarea cancelada durante la preparación", job_id=job_id, phase="cancelled")
+        return result
+    finish_scheduled_task(job_id, result)
+    return result
+
+def finish_scheduled_task(job_id, result):
+    """Registra el resultado y limpia el trabajo de memoria"""
+    log_message(f"🎯 [{job_id}] Resultado: {result}", job_id=job_id, phase="result", status=result.get("status"))
+    job_journal.append({"e": "complete", "id": job_id, "status": result.get("status"), "result": result})
+    # Se publica antes de borrarlo: quien espere nunca ve el trabajo sin su resultado
+    record = job_registry.get(job_id)
+    publish_job_result(job_id, result, record.device_name if record else None)
+    JOBS_FINISHED.inc(result.get("status", "unknown"))
+    if result.get("status") != "success":
+        FAILURES.inc("job")
+
+    # LIMPIAR INMEDIATAMENTE después de ejecutar
+    if job_registry.remove(job_id) is not None:
+        log_message(f"🧹 [{job_id}] Trabajo completado eliminado de memoria", job_id=job_id, phase="cleanup")
+
+scheduler = TimerScheduler(dispatch_due_jobs, lead=prepare_latency.current_lead)
+scheduler_leadership = SchedulerLeadership(SCHEDULER_LOCK_PATH)
+
+metrics.register(Gauge(
+    "meross_timer_jobs_pending",
+    "Trabajos esperando en el planificador de este worker",
+    scheduler.pending_count
+))
+metrics.register(Gauge(
+    "meross_timer_jobs_in_flight",
+    "Trabajos ejecutándose ahora mismo",
+    lambda: job_registry.count_by_status().get("executing", 0)
+))
+metrics.register(Gauge(
+    "meross_timer_jobs_active",
+    "Trabajos activos por estado",
+    job_registry.count_by_status,
+    label="status"
+))
+metrics.register(Gauge(
+    "meross_timer_scheduler_leader",
+    "1 si este worker es el líder del planificador",
+    lambda: int(scheduler_leadership.is_leader)
+))
+startup.record("app_setup", IMPORTS_DONE)
+job_service_started = time.perf_counter()
+start_job_service()
+startup.record("job_service", job_service_started)
+
+def validate_timer_entry(entry):
+    """Valida una entrada {device_name, action, minutes, conflict}; devuelve (datos, error)"""
+    device_name = entry.get('device_name')
+    conflict = entry.get('conflict')
+    action = str(entry.get('action', 'off')).lower()
+    try:
+        minutes = int(entry.get('minutes', 1))
+    except (TypeError, ValueError):
+        return None, "minutes debe ser un número entero"
+
+    if not device_name:
+        return None, "Faltan parámetros requeridos"
+    if action not in ('on', 'off'):
+        return None, f"Acción '{action}' no válida (usar 'on' u 'off')"
+    if minutes < 0:
+        return None, "El tiempo mínimo es 0 minutos"
+    if minutes > 1440:  # 24 horas
+        return None, "El tiempo máximo es 1440 minutos (24 horas)"
+    if conflict is not None and conflict not in CONFLICT_POLICIES:
+        return None, f"conflict debe ser uno de: {', '.join(CONFLICT_POLICIES)}"
+    return (device_name, action, minutes, conflict), None
 
 # ===== ENDPOINTS =====
 
+@app.after_request
+def mark_first_response(response):
+    startup.mark("first_response")
+    return response
+
 @app.route('/', methods=['GET'])
 def health_check():
     """Health check endpoint para Render"""
@@ -164,8 +2755,21 @@ def health_check():
         "timestamp": datetime.now(SPAIN_TZ).isoformat(),
         "features": [
             "meross-iot library integration",
+            "Persistent shared Meross session",
+            "Device discovery cache",
+            "Push-fed device state cache",
+            "LAN-first control with cloud fallback (meross-iot)",
             "Timer scheduling",
+            "Recurring DST-aware schedules",
+            "Batched execution of coalesced timers",
+            "Pre-warmed execution firing at the exact due time",
             "Job management",
+            "Multi-device scenes executed concurrently",
+            "Durable job journal",
+            "Prometheus metrics",
+            "Job lifecycle events (SSE and long-poll)",
+            "Multiple Meross accounts and regions",
+            "Fast cold start with background warm-up",
             "Spain timezone support"
         ]
     })
@@ -174,9 +2778,20 @@ def health_check():
 def get_status():
     try:
         now_spain = datetime.now(SPAIN_TZ)
+        # El calentamiento del arranque puede estar creando sesiones ahora mismo
+        with meross_sessions_lock:
+            sessions = dict(meross_sessions)
         return jsonify({
-            "scheduler_available": True,
-            "active_jobs": len(active_tasks),
+            "scheduler_available": scheduler.is_alive(),
+            "active_jobs": len(job_registry),
+            "pending_timers": scheduler.pending_count(),
+            "journal": job_journal.info(),
+            "events": job_events.info(),
+            "prewarm": prepare_latency.info(),
+            "worker": scheduler_leadership.info(),
+            "startup": startup.info(),
+            "accounts": [account.info() for account in meross_accounts.values()],
+            "meross_sessions": {email: session.info() for email, session in sessions.items()},
             "spain_time": now_spain.strftime('%H:%M:%S %d/%m/%Y %Z'),
             "timestamp": now_spain.isoformat(),
             "system": "Render deployment",
@@ -189,107 +2804,358 @@ def get_status():
             "error": str(e)
         }), 500
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Métricas de este worker en formato de texto de Prometheus"""
+    return app.response_class(metrics.render(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
 @app.route('/jobs', methods=['GET'])
 def get_jobs():
+    """Trabajos activos. Filtros: ?device=, ?status=; paginación: ?limit=, ?cursor="""
     try:
-        now_spain = datetime.now(SPAIN_TZ)
-        jobs_info = []
-        
-        for job_id, task in active_tasks.items():
-            try:
-                execution_time = datetime.fromisoformat(task['execution_time'])
-                execution_time_spain = execution_time.strftime('%H:%M:%S %d/%m/%Y')
-                
-                time_remaining = execution_time - now_spain
-                remaining_seconds = max(0, int(time_remaining.total_seconds()))
-                remaining_minutes = remaining_seconds // 60
-                
-                job_info = {
-                    "id": job_id,
-                    "name": f"Control {task['device_name']} -> {task['action']}",
-                    "execution_time": task['execution_time'],
-                    "execution_time_spain": execution_time_spain,
-                    "status": task.get('status', 'unknown'),
-                    "remaining_minutes": remaining_minutes,
-                    "remaining_seconds": remaining_seconds
-                }
-                
-                if task.get('status') == "completed" and 'result' in task:
-                    job_info['result'] = task['result']
-                elif task.get('status') == "error" and 'error' in task:
-                    job_info['error'] = task['error']
-                
-                jobs_info.append(job_info)
-                
-            except Exception as e:
-                log_message(f"❌ Error procesando job {job_id}: {str(e)}")
-        
-        return jsonify({
+        # Sin cambios en el registro ni de franja desde el último sondeo: 304 sin cuerpo
+        now = time.time()
+        if JOBS_ETAG_INTERVAL > 0:
+            now -= now % JOBS_ETAG_INTERVAL
+        etag = f"{job_registry.etag}.{int(now * 1000)}"
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            return response
+
+        try:
+            cursor = int(request.args.get('cursor', 0))
+            limit = min(max(int(request.args.get('limit', JOBS_PAGE_SIZE)), 1), JOBS_PAGE_MAX)
+        except ValueError:
+            return jsonify({"status": "error", "message": "cursor y limit deben ser enteros"}), 400
+
+        page, matched, next_cursor = job_registry.query(
+            device=request.args.get('device'),
+            status=request.args.get('status'),
+            cursor=cursor,
+            limit=limit
+        )
+        now_spain = datetime.fromtimestamp(now, SPAIN_TZ)
+        response = jsonify({
             "status": "success",
-            "active_jobs": len(active_tasks),
-            "jobs": jobs_info,
+            "active_jobs": len(job_registry),
+            "matched_jobs": matched,
+            "jobs": [record.to_dict(now) for record in page],
+            "next_cursor": str(next_cursor) if next_cursor is not None else None,
             "spain_time": now_spain.strftime('%H:%M:%S %d/%m/%Y %Z'),
             "timestamp": now_spain.isoformat()
         })
+        response.set_etag(etag)
+        return response
         
     except Exception as e:
         log_message(f"💥 Error en /jobs: {str(e)}")
         return jsonify({
             "status": "error",
             "message": str(e),
-            "active_jobs": len(active_tasks) if 'active_tasks' in globals() else 0
+            "active_jobs": len(job_registry)
         }), 500
 
+@app.route('/jobs/<job_id>/wait', methods=['GET'])
+def wait_job(job_id):
+    """Long-poll: responde cuando el trabajo termina o a los ?timeout= segundos"""
+    try:
+        timeout = min(max(float(request.args.get('timeout', 30)), 0), JOB_WAIT_MAX)
+    except ValueError:
+        return jsonify({"status": "error", "message": "timeout debe ser un número"}), 400
+
+    event = job_events.find_final(job_id)
+    if event is None:
+        if job_id not in job_registry:
+            return jsonify({"status": "error", "message": f"Job {job_id} no encontrado"}), 404
+        event = job_events.wait_final(job_id, timeout)
+
+    if event is None:
+        record = job_registry.get(job_id)
+        return jsonify({
+            "status": "success",
+            "done": False,
+            "job": record.to_dict(time.time()) if record else None
+        })
+    return jsonify({"status": "success", "done": True, "event": event})
+
+event_streams = threading.BoundedSemaphore(EVENTS_MAX_STREAMS)
+
+@app.route('/events', methods=['GET'])
+def stream_events():
+    """Stream SSE de eventos de trabajos; reanuda desde Last-Event-ID (o ?last_event_id=)"""
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    job_filter = request.args.get('job_id')
+    device_filter = request.args.get('device')
+    # Sin id se empieza por lo nuevo; con un id ajeno se reenvía todo el anillo
+    last_id = job_events.parse_id(last_event_id) if last_event_id else job_events.info()["last_id"]
+    if not event_streams.acquire(blocking=False):
+        response = jsonify({"status": "error",
+                            "message": f"Máximo {EVENTS_MAX_STREAMS} streams de eventos por worker; "
+                                       "usa /jobs/<id>/wait o reintenta"})
+        response.status_code = 503
+        response.headers["Retry-After"] = str(int(EVENTS_HEARTBEAT))
+        return response
+
+    def generate():
+        nonlocal last_id
+        yield "retry: 3000\n\n"
+        deadline = time.monotonic() + EVENTS_STREAM_TIMEOUT
+        while time.monotonic() < deadline:
+            events, gap = job_events.wait(last_id, EVENTS_HEARTBEAT)
+            if gap:
+                yield "event: gap\ndata: {}\n\n"
+            if last_id is None:
+                # Id ajeno ya respondido con el anillo: se sigue desde lo último que
+                # contenía (un anillo vacío es que aún no se ha publicado nada)
+                last_id = events[-1]["id"] if events else 0
+            if not events:
+                yield ": keepalive\n\n"
+                continue
+            last_id = events[-1]["id"]
+            for event in events:
+                if job_filter and event["job_id"] != job_filter:
+                    continue
+                if device_filter and event.get("device") != device_filter:
+                    continue
+                yield (f"id: {job_events.format_id(event)}\n"
+                       f"event: {event['type']}\n"
+                       f"data: {json.dumps(event, ensure_ascii=False, default=str)}\n\n")
+
+    response = app.response_class(generate(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+    # Se libera al cerrarse la respuesta, aunque el cliente corte antes de empezar
+    response.call_on_close(event_streams.release)
+    return response
+
+@app.route('/schedules', methods=['GET'])
+def list_schedules():
+    """Reglas recurrentes con su próxima ejecución"""
+    with recurring_rules_lock:
+        rules = [rule.to_dict() for rule in recurring_rules.values()]
+    return jsonify({"status": "success", "schedules": rules, "count": len(rules)})
+
+@app.route('/schedules', methods=['POST'])
+def create_schedule():
+    """Regla recurrente: {device_name, action, cron} o {device_name, action, days, time}"""
+    try:
+        data = request.get_json() or {}
+        email, password, error = request_credentials(data)
+        api_key_env = os.getenv('MEROSS_API_KEY')
+
+        if error:
+            return jsonify({"status": "error", "message": error[0]}), error[1]
+        if api_key_env and data.get('api_key') != api_key_env:
+            return jsonify({"status": "error", "message": "Clave API inválida"}), 401
+
+        device_name = data.get('device_name')
+        action = str(data.get('action', 'off')).lower()
+        if not device_name:
+            return jsonify({"status": "error", "message": "Faltan parámetros requeridos"}), 400
+        if action not in ('on', 'off'):
+            return jsonify({"status": "error", "message": f"Acción '{action}' no válida (usar 'on' u 'off')"}), 400
+        expression, error = build_cron_expression(data)
+        if error:
+            return jsonify({"status": "error", "message": error}), 400
+
+        rule_id = f"rule_{new_job_id(device_name, action)}"
+        rule = RecurringRule(rule_id, email, device_name, action, expression, time.time())
+        next_fire = add_recurring_rule(rule)
+        log_message(f"🔁 [{rule_id}] Regla '{expression}' para {device_name} -> {action}, próxima: "
+                    f"{next_fire.strftime('%H:%M:%S %d/%m/%Y %Z') if next_fire else 'ninguna'}")
+        return jsonify({"status": "success", "schedule": rule.to_dict()})
+
+    except Exception as e:
+        log_message(f"💥 Error en /schedules: {str(e)}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/schedules/<rule_id>', methods=['DELETE'])
+def delete_schedule(rule_id):
+    data = request.get_json(silent=True) or {}
+    api_key_env = os.getenv('MEROSS_API_KEY')
+    if api_key_env and data.get('api_key') != api_key_env:
+        return jsonify({"status": "error", "message": "Clave API inválida"}), 401
+    if remove_recurring_rule(rule_id) is None:
+        return jsonify({"status": "error", "message": f"Regla {rule_id} no encontrada"}), 404
+    log_message(f"✅ Regla eliminada: {rule_id}")
+    return jsonify({"status": "success", "message": f"Regla {rule_id} eliminada"})
+
+def device_view(session, device):
+    """Dispositivo descubierto con su último estado conocido, sin tocar la red"""
+    online = session.states.online(device.uuid)
+    if online is None:
+        online_status = getattr(device, 'online_status', None)
+        online = online_status.value == 1 if online_status else None
+    return {"name": device.name, "uuid": device.uuid, "type": str(device.type),
+            "online": online, **session.states.view(device.uuid)}
+
+def request_device_session():
+    """(sesión, error) de la cuenta pedida con ?account="""
+    email, password, error = request_credentials()
+    return (None, error) if error else (get_meross_session(email, password), None)
+
+@app.route('/devices', methods=['GET'])
+def list_devices():
+    """Dispositivos y estados desde la caché; si aún no hay descubrimiento, lo lanza"""
+    session, error = request_device_session()
+    if error:
+        return jsonify({"status": "error", "message": error[0]}), error[1]
+    if not session.devices.is_loaded():
+        start_device_warm_up(session, "devices")
+        return jsonify({"status": "success", "loaded": False, "devices": [], "count": 0,
+                        "message": "Cargando dispositivos, vuelve a consultar en unos segundos"})
+    devices = [device_view(session, device) for device in session.devices.all()]
+    return jsonify({"status": "success", "loaded": True, "devices": devices, "count": len(devices),
+                    "state_ttl_seconds": session.states.ttl})
+
+@app.route('/devices/<device_name>', methods=['GET'])
+def get_device(device_name):
+    session, error = request_device_session()
+    if error:
+        return jsonify({"status": "error", "message": error[0]}), error[1]
+    if not session.devices.is_loaded():
+        start_device_warm_up(session, "devices")
+        return jsonify({"status": "error", "loaded": False,
+                        "message": "Cargando dispositivos, vuelve a consultar en unos segundos"}), 503
+    device = session.devices.lookup(device_name)
+    if device is None:
+        return jsonify({"status": "error", "message": f"Dispositivo '{device_name}' no encontrado"}), 404
+    return jsonify({"status": "success", "device": device_view(session, device)})
+
+@app.route('/scenes', methods=['GET'])
+def list_scenes():
+    with scenes_lock:
+        defined = [scene.to_dict() for scene in scenes.values()]
+    return jsonify({"status": "success", "scenes": defined, "count": len(defined)})
+
+@app.route('/scenes', methods=['POST'])
+def create_scene():
+    """Define (o redefine) una escena: {name, devices: [{device_name, action}, ...]}"""
+    try:
+        data = request.get_json() or {}
+        email, _, error = request_credentials(data)
+        api_key_env = os.getenv('MEROSS_API_KEY')
+
+        if error:
+            return jsonify({"status": "error", "message": error[0]}), error[1]
+        if api_key_env and data.get('api_key') != api_key_env:
+            return jsonify({"status": "error", "message": "Clave API inválida"}), 401
+
+        name = data.get('name')
+        if not isinstance(name, str) or not name.strip():
+            return jsonify({"status": "error", "message": "name es requerido"}), 400
+        actions, error = parse_scene_actions(data.get('devices'))
+        if error:
+            return jsonify({"status": "error", "message": error}), 400
+
+        scene = Scene(name.strip(), email, actions, time.time())
+        add_scene(scene)
+        log_message(f"🎬 Escena '{scene.name}': {', '.join(f'{d} -> {a}' for d, a in actions)}")
+        return jsonify({"status": "success", "scene": scene.to_dict()})
+
+    except Exception as e:
+        log_message(f"💥 Error en /scenes: {str(e)}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/scenes/<name>', methods=['DELETE'])
+def delete_scene(name):
+    data = request.get_json(silent=True) or {}
+    api_key_env = os.getenv('MEROSS_API_KEY')
+    if api_key_env and data.get('api_key') != api_key_env:
+        return jsonify({"status": "error", "message": "Clave API inválida"}), 401
+    if remove_scene(name) is None:
+        return jsonify({"status": "error", "message": f"Escena '{name}' no encontrada"}), 404
+    log_message(f"✅ Escena eliminada: {name}")
+    return jsonify({"status": "success", "message": f"Escena '{name}' eliminada"})
+
+@app.route('/scenes/<name>/run', methods=['POST'])
+def run_scene_now(name):
+    """Ejecuta ya todas las acciones de la escena en paralelo y devuelve el resultado de cada una"""
+    try:
+        data = request.get_json(silent=True) or {}
+        api_key_env = os.getenv('MEROSS_API_KEY')
+
+        if api_key_env and data.get('api_key') != api_key_env:
+            return jsonify({"status": "error", "message": "Clave API inválida"}), 401
+
+        with scenes_lock:
+            scene = scenes.get(name)
+        if scene is None:
+            return jsonify({"status": "error", "message": f"Escena '{name}' no encontrada"}), 404
+        # La escena se ejecuta con la cuenta con la que se definió
+        email, password = scene.account, account_password(scene.account)
+        if password is None:
+            return jsonify({"status": "error", "message": f"Cuenta {scene.account} no configurada"}), 500
+
+        run_id = f"scene_{uuid.uuid4().hex[:8]}"
+        log_message(f"🎬 [{run_id}] Ejecutando escena '{name}' ({len(scene.actions)} dispositivos)", job_id=run_id)
+        session = get_meross_session(email, password)
+        try:
+            results, duration_ms = session.run(run_scene(email, password, scene, run_id), SCENE_RUN_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            log_message(f"⌛ [{run_id}] Escena '{name}' sin terminar en {SCENE_RUN_TIMEOUT}s", job_id=run_id)
+            return jsonify({
+                "status": "error",
+                "message": f"La escena no terminó en {SCENE_RUN_TIMEOUT} segundos"
+            }), 504
+
+        succeeded = sum(1 for result in results if result.get("status") == "success")
+        log_message(f"🎬 [{run_id}] Escena '{name}': {succeeded}/{len(results)} en {duration_ms} ms",
+                    job_id=run_id, phase="scene", duration_ms=duration_ms)
+        return jsonify({
+            "status": "success" if succeeded == len(results) else "partial" if succeeded else "error",
+            "scene": name,
+            "run_id": run_id,
+            "succeeded": succeeded,
+            "duration_ms": duration_ms,
+            "results": results
+        }), 200 if succeeded else 502
+
+    except Exception as e:
+        log_message(f"💥 Error ejecutando escena: {str(e)}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
 @app.route('/timer', methods=['POST'])
 def set_timer():
     try:
         data = request.get_json()
         
-        email = os.getenv('MEROSS_EMAIL')
-        password = os.getenv('MEROSS_PASSWORD')
+        email, password, error = request_credentials(data)
         api_key_env = os.getenv('MEROSS_API_KEY')
         
-        device_name = data.get('device_name')
-        minutes = int(data.get('minutes', 1))
-        action = data.get('action', 'off')
         api_key = data.get('api_key')
         
         # Validaciones
-        if not all([email, password, device_name]):
-            return jsonify({"status": "error", "message": "Faltan parámetros requeridos"}), 400
+        if error:
+            return jsonify({"status": "error", "message": error[0]}), error[1]
         
         # Solo validar API key si está configurada
         if api_key_env and api_key != api_key_env:
             return jsonify({"status": "error", "message": "Clave API inválida"}), 401
         
-        if minutes < 0:
-            return jsonify({"status": "error", "message": "El tiempo mínimo es 0 minutos"}), 400
-        
-        if minutes > 1440:  # 24 horas
-            return jsonify({"status": "error", "message": "El tiempo máximo es 1440 minutos (24 horas)"}), 400
-        
-        # Crear ID único
-        now = datetime.now(SPAIN_TZ)
-        job_id = f"{device_name}_{action}_{now.strftime('%Y%m%d_%H%M%S')}"
+        parsed, error = validate_timer_entry(data)
+        if error:
+            return jsonify({"status": "error", "message": error}), 400
+        device_name, action, minutes, conflict = parsed
         
         log_message(f"🕐 Programando: {device_name} -> {action} en {minutes} minutos")
         
-        # Ejecutar en hilo separado para no bloquear la respuesta HTTP
-        thread = threading.Thread(
-            target=execute_delayed_task,
-            args=(email, password, device_name, action, minutes, job_id),
-            daemon=True
-        )
-        thread.start()
-        
-        execution_time = now + timedelta(minutes=minutes)
+        # El planificador único se encarga de la espera; la respuesta HTTP no se bloquea
+        outcome = schedule_timer(email, password, device_name, action, minutes, conflict)
+        execution_time = outcome["execution_time"]
         
         return jsonify({
             "status": "success",
-            "message": f"Programado {action} en {device_name} después de {minutes} minutos",
-            "job_id": job_id,
+            "message": (f"Ya había un {action} programado en {device_name}: se mantiene" if outcome["deduplicated"]
+                        else f"Programado {action} en {device_name} después de {minutes} minutos"),
+            "job_id": outcome["job_id"],
             "execution_time": execution_time.isoformat(),
             "execution_time_spain": execution_time.strftime('%H:%M:%S %d/%m/%Y'),
+            "conflict_policy": outcome["policy"],
+            "deduplicated": outcome["deduplicated"],
+            "superseded_jobs": outcome["superseded"],
             "platform": "render"
         })
         
@@ -297,33 +3163,96 @@ def set_timer():
         log_message(f"💥 Error: {str(e)}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
+# Máximo de temporizadores aceptados en una sola petición bulk
+MAX_BULK_TIMERS = 100
+
+@app.route('/timer/bulk', methods=['POST'])
+def set_timers_bulk():
+    """Programa varios temporizadores en una petición: {"timers": [{device_name, action, minutes}, ...]}"""
+    try:
+        data = request.get_json() or {}
+        
+        email, password, error = request_credentials(data)
+        api_key_env = os.getenv('MEROSS_API_KEY')
+        
+        timers = data.get('timers')
+        api_key = data.get('api_key')
+        
+        if error:
+            return jsonify({"status": "error", "message": error[0]}), error[1]
+        
+        # Solo validar API key si está configurada
+        if api_key_env and api_key != api_key_env:
+            return jsonify({"status": "error", "message": "Clave API inválida"}), 401
+        
+        if not isinstance(timers, list) or not timers:
+            return jsonify({"status": "error", "message": "timers debe ser una lista no vacía"}), 400
+        
+        if len(timers) > MAX_BULK_TIMERS:
+            return jsonify({"status": "error", "message": f"Máximo {MAX_BULK_TIMERS} temporizadores por petición"}), 400
+        
+        results = []
+        for index, entry in enumerate(timers):
+            parsed, error = validate_timer_entry(entry if isinstance(entry, dict) else {})
+            if error:
+                results.append({"index": index, "status": "error", "message": error})
+                continue
+            
+            device_name, action, minutes, conflict = parsed
+            outcome = schedule_timer(email, password, device_name, action, minutes, conflict, durable=False)
+            execution_time = outcome["execution_time"]
+            results.append({
+                "index": index,
+                "status": "success",
+                "job_id": outcome["job_id"],
+                "device_name": device_name,
+                "action": action,
+                "execution_time": execution_time.isoformat(),
+                "execution_time_spain": execution_time.strftime('%H:%M:%S %d/%m/%Y'),
+                "deduplicated": outcome["deduplicated"],
+                "superseded_jobs": outcome["superseded"]
+            })
+        
+        # Un solo fsync para todo el bloque antes de confirmar
+        job_journal.sync()
+        scheduled = sum(1 for r in results if r["status"] == "success")
+        log_message(f"🕐 Programados {scheduled}/{len(timers)} temporizadores en bloque")
+        
+        return jsonify({
+            "status": "success" if scheduled == len(timers) else "partial" if scheduled else "error",
+            "scheduled": scheduled,
+            "results": results,
+            "platform": "render"
+        }), 200 if scheduled else 400
+        
+    except Exception as e:
+        log_message(f"💥 Error: {str(e)}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
 # ===== ENDPOINTS SIMPLIFICADOS =====
 
 @app.route('/kodiplex/off/<int:minutes>', methods=['GET'])
 def kodiplex_off_quick(minutes):
     """Atajo rápido: GET /kodiplex/off/30"""
     try:
-        email = os.getenv('MEROSS_EMAIL')
-        password = os.getenv('MEROSS_PASSWORD')
+        email, password, error = request_credentials()
         
-        if not email or not password:
-            return jsonify({"error": "Variables de entorno no configuradas"}), 500
+        if error:
+            return jsonify({"error": error[0]}), error[1]
         
-        now = datetime.now(SPAIN_TZ)
-        job_id = f"KodiPlex_off_{now.strftime('%Y%m%d_%H%M%S')}"
-        
-        thread = threading.Thread(
-            target=execute_delayed_task,
-            args=(email, password, "KodiPlex", "off", minutes, job_id),
-            daemon=True
-        )
-        thread.start()
+        conflict = request.args.get('conflict')
+        if conflict is not None and conflict not in CONFLICT_POLICIES:
+            return jsonify({"error": f"conflict debe ser uno de: {', '.join(CONFLICT_POLICIES)}"}), 400
         
-        execution_time = now + timedelta(minutes=minutes)
+        now = datetime.now(SPAIN_TZ)
+        outcome = schedule_timer(email, password, "KodiPlex", "off", minutes, conflict)
+        execution_time = outcome["execution_time"]
         
         return jsonify({
             "message": f"🔌 KodiPlex se apagará en {minutes} minutos",
-            "job_id": job_id,
+            "job_id": outcome["job_id"],
+            "deduplicated": outcome["deduplicated"],
+            "superseded_jobs": outcome["superseded"],
             "execution_time_spain": execution_time.strftime('%H:%M:%S %d/%m/%Y'),
             "current_time": now.strftime('%H:%M:%S')
         })
@@ -335,27 +3264,24 @@ def kodiplex_off_quick(minutes):
 def kodiplex_on_quick(minutes):
     """Atajo rápido: GET /kodiplex/on/30"""
     try:
-        email = os.getenv('MEROSS_EMAIL')
-        password = os.getenv('MEROSS_PASSWORD')
+        email, password, error = request_credentials()
         
-        if not email or not password:
-            return jsonify({"error": "Variables de entorno no configuradas"}), 500
+        if error:
+            return jsonify({"error": error[0]}), error[1]
         
-        now = datetime.now(SPAIN_TZ)
-        job_id = f"KodiPlex_on_{now.strftime('%Y%m%d_%H%M%S')}"
-        
-        thread = threading.Thread(
-            target=execute_delayed_task,
-            args=(email, password, "KodiPlex", "on", minutes, job_id),
-            daemon=True
-        )
-        thread.start()
+        conflict = request.args.get('conflict')
+        if conflict is not None and conflict not in CONFLICT_POLICIES:
+            return jsonify({"error": f"conflict debe ser uno de: {', '.join(CONFLICT_POLICIES)}"}), 400
         
-        execution_time = now + timedelta(minutes=minutes)
+        now = datetime.now(SPAIN_TZ)
+        outcome = schedule_timer(email, password, "KodiPlex", "on", minutes, conflict)
+        execution_time = outcome["execution_time"]
         
         return jsonify({
             "message": f"🔌 KodiPlex se encenderá en {minutes} minutos",
-            "job_id": job_id,
+            "job_id": outcome["job_id"],
+            "deduplicated": outcome["deduplicated"],
+            "superseded_jobs": outcome["superseded"],
             "execution_time_spain": execution_time.strftime('%H:%M:%S %d/%m/%Y'),
             "current_time": now.strftime('%H:%M:%S')
         })
@@ -378,10 +3304,21 @@ def cancel_job():
         if api_key_env and api_key != api_key_env:
             return jsonify({"status": "error", "message": "Clave API inválida"}), 401
         
-        if job_id in active_tasks:
-            task_status = active_tasks[job_id].get("status", "unknown")
-            if task_status == "waiting":
-                del active_tasks[job_id]
+        record = job_registry.get(job_id)
+        if record is not None:
+            task_status = record.status
+            if task_status in CANCELLABLE_STATUSES and not scheduler_leadership.is_leader:
+                # Solo el líder sabe si el trabajo ya ha salido: se le pide y
+                # la confirmación llega como evento `cancelled` en /events
+                job_journal.append({"e": "cancel_request", "id": job_id})
+                log_message(f"📨 Cancelación de {job_id} enviada al worker planificador")
+                return jsonify({
+                    "status": "pending",
+                    "message": f"Cancelación del job {job_id} solicitada; se confirma en /events o /jobs"
+                }), 202
+            if task_status in CANCELLABLE_STATUSES:
+                # Liberar el trabajo del planificador al momento
+                cancel_job_entry(job_id)
                 log_message(f"✅ Job cancelado: {job_id}")
                 return jsonify({
                     "status": "success",
@@ -419,42 +3356,40 @@ def test_connection():
                 log_message("❌ API Key inválida")
                 return jsonify({"status": "error", "message": "Clave API inválida"}), 401
 
-        email = os.getenv('MEROSS_EMAIL')
-        password = os.getenv('MEROSS_PASSWORD')
+        email, password, error = request_credentials(data if request.method == 'POST' else None)
         
         log_message(f"📧 Email configurado: {'SÍ' if email else 'NO'}")
         log_message(f"🔐 Password configurado: {'SÍ' if password else 'NO'}")
         
-        if not email or not password:
-            log_message("❌ Variables de entorno faltantes")
+        if error:
+            log_message(f"❌ {error[0]}")
             return jsonify({
                 "status": "error",
-                "message": "Variables de entorno MEROSS_EMAIL o MEROSS_PASSWORD no configuradas"
-            }), 500
+                "message": error[0] if error[1] == 404 else
+                "Variables de entorno MEROSS_EMAIL o MEROSS_PASSWORD (o MEROSS_ACCOUNTS) no configuradas"
+            }), error[1]
 
         # Crear job_id temporal para logs
         test_job_id = f"test_connection_{datetime.now(SPAIN_TZ).strftime('%H%M%S')}"
         log_message(f"🆔 Job ID creado: {test_job_id}")
 
-        # Ejecutar test en un hilo separado para no bloquear
-        def test_async():
-            try:
-                log_message("🔄 Iniciando loop asyncio")
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                try:
-                    result = loop.run_until_complete(test_meross_connection(email, password, test_job_id))
-                    log_message(f"✅ Resultado obtenido: {result.get('status', 'unknown')}")
-                    return result
-                finally:
-                    loop.close()
-                    log_message("🔄 Loop asyncio cerrado")
-            except Exception as e:
-                log_message(f"💥 Error en test_async: {str(e)}")
-                return {"status": "error", "message": f"Error interno: {str(e)}"}
-
+        # Reutilizar un test reciente o compartir el que esté en curso
         log_message("🚀 Ejecutando test asíncrono")
-        result = test_async()
+        refresh = request.args.get('refresh', '').lower() in ('1', 'true', 'yes')
+        try:
+            result, age = get_connection_snapshot(email, password, test_job_id, refresh)
+            result = {**result, "cached": age is not None, "snapshot_age_seconds": age}
+            log_message(f"✅ Resultado obtenido: {result.get('status', 'unknown')}")
+        except concurrent.futures.TimeoutError:
+            log_message(f"⌛ Test de conexión sin respuesta en {CONNECTION_TEST_TIMEOUT}s")
+            return jsonify({
+                "status": "error",
+                "message": f"Sin respuesta de Meross en {CONNECTION_TEST_TIMEOUT} segundos"
+            }), 504
+        except Exception as e:
+            log_message(f"💥 Error en test_async: {str(e)}")
+            result = {"status": "error", "message": f"Error interno: {str(e)}"}
+
         log_message(f"📤 Enviando respuesta: {result}")
         
         return jsonify(result)
@@ -463,79 +3398,195 @@ def test_connection():
         log_message(f"💥 Error crítico en test_connection: {str(e)}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
-async def test_meross_connection(email, password, job_id):
-    """Test de conexión asíncrono"""
-    http_api_client = None
-    manager = None
+# Concurrencia y timeout del sondeo de dispositivos en /test-connection
+DEVICE_POLL_CONCURRENCY = int(os.getenv('DEVICE_POLL_CONCURRENCY', 4))
+DEVICE_POLL_TIMEOUT = float(os.getenv('DEVICE_POLL_TIMEOUT', 5))
+# Vida útil del último resultado y espera máxima del endpoint (segundos)
+CONNECTION_SNAPSHOT_TTL = float(os.getenv('CONNECTION_SNAPSHOT_TTL', 30))
+CONNECTION_TEST_TIMEOUT = float(os.getenv('CONNECTION_TEST_TIMEOUT', 30))
+
+connection_snapshots = {}       # email -> (time.monotonic(), resultado)
+connection_tests_running = {}   # email -> concurrent.futures.Future
+connection_snapshots_lock = threading.RLock()
+
+def get_connection_snapshot(email, password, job_id, refresh=False):
+    """Devuelve (resultado, antigüedad) del test de conexión.
+
+    Sirve el último resultado si tiene menos de CONNECTION_SNAPSHOT_TTL
+    segundos; si no, se une al test en curso o lanza uno nuevo en el loop de
+    la sesión (antigüedad None).
+    """
+    with connection_snapshots_lock:
+        cached = connection_snapshots.get(email)
+        if cached and not refresh:
+            age = time.monotonic() - cached[0]
+            if age < CONNECTION_SNAPSHOT_TTL:
+                return cached[1], round(age, 1)
+
+        future = connection_tests_running.get(email)
+        if future is None:
+            session = get_meross_session(email, password)
+            future = session.submit(test_meross_connection(email, password, job_id, refresh))
+            connection_tests_running[email] = future
+            future.add_done_callback(lambda f: _store_connection_snapshot(email, f))
+
+    return future.result(CONNECTION_TEST_TIMEOUT), None
+
+def _store_connection_snapshot(email, future):
+    with connection_snapshots_lock:
+        connection_tests_running.pop(email, None)
+        if not future.cancelled() and future.exception() is None:
+            result = future.result()
+            # Los errores no se cachean: el siguiente intento vuelve a probar
+            if result.get("status") == "success":
+                connection_snapshots[email] = (time.monotonic(), result)
+
+async def poll_device(device, semaphore, job_id, session=None):
+    """Actualiza un dispositivo con concurrencia acotada y timeout propio"""
+    async with semaphore:
+        try:
+            await asyncio.wait_for(device.async_update(), DEVICE_POLL_TIMEOUT)
+            # Convertir OnlineStatus a boolean
+            online_status = getattr(device, 'online_status', None)
+            is_online = online_status.value == 1 if online_status else True
+            if session is not None:
+                session.states.record_online(device.uuid, is_online)
+                if hasattr(device, 'is_on'):
+                    session.states.record(device.uuid, device.is_on(), "poll")
+            
+            return {
+                "name": device.name,
+                "type": str(device.type),
+                "online": is_online,
+                "state": "on" if hasattr(device, 'is_on') and device.is_on() else "off"
+            }
+        except Exception as e:
+            reason = f"timeout de {DEVICE_POLL_TIMEOUT}s" if isinstance(e, asyncio.TimeoutError) else str(e)
+            log_message(f"⚠️ [{job_id}] Error procesando dispositivo {device.name}: {reason}")
+            return {
+                "name": device.name,
+                "type": str(device.type),
+                "online": False,
+                "state": "unknown"
+            }
+
+async def test_meross_connection(email, password, job_id, refresh=False):
+    """Test de conexión asíncrono sobre la sesión compartida"""
+    session = get_meross_session(email, password)
     
     try:
+        session.breaker.check()
         log_message(f"🧪 [{job_id}] Probando conexión con Meross...")
         
-        # Conectar - API corregida para v0.4.9.0
-        http_api_client = await MerossHttpClient.async_from_user_password(
-            api_base_url='https://iotx-eu.meross.com',
-            email=email, 
-            password=password
-        )
-        log_message(f"✅ [{job_id}] Login exitoso")
-        
-        # Manager
-        manager = MerossManager(http_client=http_api_client)
-        await manager.async_init()
-        log_message(f"✅ [{job_id}] Manager inicializado")
-        
-        # Descubrir dispositivos
-        await manager.async_device_discovery()
-        devices = manager.find_devices()
+        # Dispositivos desde la caché de descubrimiento (se refresca si caducó)
+        if refresh:
+            session.devices.invalidate()
+        devices = await session.async_list_devices(job_id)
         
-        device_list = []
-        for device in devices:
-            try:
-                await device.async_update()
-                # Convertir OnlineStatus a boolean
-                online_status = getattr(device, 'online_status', None)
-                is_online = online_status.value == 1 if online_status else True
-                
-                device_list.append({
-                    "name": device.name,
-                    "type": str(device.type),
-                    "online": is_online,
-                    "state": "on" if hasattr(device, 'is_on') and device.is_on() else "off"
-                })
-            except Exception as e:
-                log_message(f"⚠️ [{job_id}] Error procesando dispositivo {device.name}: {str(e)}")
-                device_list.append({
-                    "name": device.name,
-                    "type": str(device.type),
-                    "online": False,
-                    "state": "unknown"
-                })
+        # Sondear todos los dispositivos en paralelo
+        semaphore = asyncio.Semaphore(DEVICE_POLL_CONCURRENCY)
+        device_list = await asyncio.gather(*(
+            poll_device(device, semaphore, job_id, session) for device in devices
+        ))
         
         log_message(f"✅ [{job_id}] {len(devices)} dispositivos encontrados")
+        session.breaker.record_success()
         
         return {
             "status": "success",
             "message": "Conexión exitosa con meross-iot",
             "devices_found": len(devices),
-            "devices": device_list
+            "devices": device_list,
+            "session": session.info()
         }
         
+    except CircuitOpenError as e:
+        log_message(f"⏸️ [{job_id}] {str(e)}")
+        return {
+            "status": "error",
+            "message": f"Nube Meross no disponible: {str(e)}"
+        }
     except Exception as e:
         log_message(f"💥 [{job_id}] Error en test: {str(e)}")
+        if isinstance(e, NON_RETRYABLE_ERRORS):
+            session.breaker.release()
+        else:
+            session.breaker.record_failure()
+        if isinstance(e, SESSION_ERRORS):
+            await session.async_invalidate(type(e).__name__)
         return {
             "status": "error",
             "message": f"Error de conexión: {str(e)}"
         }
-    finally:
-        if manager:
-            manager.close()
-        if http_api_client:
-            await http_api_client.async_logout()
+
+async def warm_device_cache(session, job_id):
+    """Descubre los dispositivos y lee su estado para llenar ambas cachés"""
+    try:
+        session.breaker.check()
+        devices = await session.async_list_devices(job_id)
+        semaphore = asyncio.Semaphore(DEVICE_POLL_CONCURRENCY)
+        await asyncio.gather(*(poll_device(device, semaphore, job_id, session) for device in devices))
+        session.breaker.record_success()
+        log_message(f"🔥 [{job_id}] Caché de dispositivos cargada: {len(devices)} dispositivos",
+                    job_id=job_id, devices=len(devices))
+    except CircuitOpenError as e:
+        log_message(f"⏸️ [{job_id}] Carga de dispositivos aplazada: {str(e)}", job_id=job_id)
+    except Exception as e:
+        log_message(f"⚠️ [{job_id}] Error cargando dispositivos: {str(e)}", job_id=job_id)
+        if isinstance(e, NON_RETRYABLE_ERRORS):
+            session.breaker.release()
+        else:
+            session.breaker.record_failure()
+        if isinstance(e, SESSION_ERRORS):
+            await session.async_invalidate(type(e).__name__)
+
+device_warm_up_lock = threading.Lock()
+
+def start_device_warm_up(session, job_id):
+    """Lanza warm_device_cache en el loop de la sesión si no hay una carga en curso"""
+    with device_warm_up_lock:
+        future = session.warm_up_future
+        if future is None or future.done():
+            future = session.warm_up_future = session.submit(warm_device_cache(session, job_id))
+    return future
+
+def warm_up_on_startup():
+    """Hilo de arranque: importa lo pesado y, en el líder, conecta las sesiones y llena la caché"""
+    started = time.perf_counter()
+    try:
+        load_meross_iot()
+        lazy_started = time.perf_counter()
+        for module in LAZY_MODULES:
+            importlib.import_module(module)
+        startup.record("lazy_imports", lazy_started)
+
+        # Solo el líder ejecuta trabajos: los seguidores no gastan logins de la cuenta
+        if scheduler_leadership.is_leader and meross_accounts:
+            devices_started = time.perf_counter()
+            futures = [start_device_warm_up(get_meross_session(account.email, account.password), "startup")
+                       for account in meross_accounts.values()]
+            done, not_done = concurrent.futures.wait(futures, timeout=STARTUP_WARM_UP_TIMEOUT)
+            startup.record("device_warm_up", devices_started)
+            if not_done:
+                log_message(f"⏳ Calentamiento sin terminar tras {STARTUP_WARM_UP_TIMEOUT:.0f}s: "
+                            f"{len(not_done)} de {len(futures)} cuentas", phase="startup")
+    except Exception as e:
+        log_message(f"⚠️ Error en el calentamiento del arranque: {str(e)}", phase="startup")
+    startup.record("warm_up", started)
+    startup.mark("warm_up_done")
+    info = startup.info()
+    log_message(f"🚀 Arranque del worker {os.getpid()} ({info['reference']}): "
+                + ", ".join(f"{name} {ms} ms" for name, ms in {**info["phases"], **info["milestones"]}.items()),
+                phase="startup", phases=info["phases"], milestones=info["milestones"])
+
+startup.mark("app_ready")
+if STARTUP_WARM_UP:
+    threading.Thread(target=warm_up_on_startup, name="startup-warm-up", daemon=True).start()
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     log_message(f"🚀 Iniciando Meross Timer API en puerto {port}")
-    log_message(f"📧 Email configurado: {os.getenv('MEROSS_EMAIL', 'NO CONFIGURADO')}")
+    log_message(f"📧 Cuentas configuradas: {', '.join(f'{a.name} ({a.region})' for a in meross_accounts.values()) or 'NINGUNA'}")
     log_message(f"🔑 API Key configurada: {'SÍ' if os.getenv('MEROSS_API_KEY') else 'NO (opcional)'}")
     
     # Mostrar rutas disponibles
@@ -543,11 +3594,24 @@ if __name__ == '__main__':
     print("GET  /                     - Health check")
     print("GET  /status               - Estado del servicio")
     print("GET  /jobs                 - Ver trabajos activos")
-    print("GET  /test-connection      - Probar conexión (sin API key)")
+    print("GET  /jobs/<id>/wait       - Esperar el resultado de un trabajo (long-poll)")
+    print("GET  /events               - Eventos de trabajos en vivo (SSE)")
+    print("GET  /metrics              - Métricas Prometheus")
+    print("GET  /devices              - Dispositivos y último estado conocido (caché)")
+    print("GET  /devices/<nombre>     - Un dispositivo desde la caché")
+    print("GET  /test-connection      - Probar conexión (sin API key, ?refresh=1 fuerza)")
     print("POST /test-connection      - Probar conexión (con API key)")
     print("GET  /kodiplex/off/<min>   - Apagar KodiPlex en X minutos")
     print("GET  /kodiplex/on/<min>    - Encender KodiPlex en X minutos")
     print("POST /timer                - Temporizador personalizado")
+    print("POST /timer/bulk           - Varios temporizadores en una petición")
+    print("GET  /schedules            - Ver reglas recurrentes")
+    print("POST /schedules            - Regla recurrente (cron o días + hora)")
+    print("DELETE /schedules/<id>     - Eliminar regla recurrente")
+    print("GET  /scenes               - Ver escenas")
+    print("POST /scenes               - Definir escena (varios dispositivos y acciones)")
+    print("POST /scenes/<nombre>/run  - Ejecutar escena ya, en paralelo")
+    print("DELETE /scenes/<nombre>    - Eliminar escena")
     print("POST /cancel-job           - Cancelar trabajo")
     print("========================\n")
     
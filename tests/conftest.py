@@ -0,0 +1,18 @@
+"""Entorno de las pruebas: nube simulada, sin diario compartido y sin calentamiento.
+
+temporizador.py lee su configuración al importarse, así que se fija aquí,
+antes de que ningún módulo de pruebas lo importe.
+"""
+
+import os
+import sys
+
+os.environ["MEROSS_FAKE_CLOUD"] = "1"
+os.environ["MEROSS_EMAIL"] = "test@example.com"
+os.environ["MEROSS_PASSWORD"] = "test"
+os.environ.pop("MEROSS_ACCOUNTS", None)
+os.environ.pop("MEROSS_API_KEY", None)
+os.environ["JOB_JOURNAL_PATH"] = ""
+os.environ["STARTUP_WARM_UP"] = "false"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,24 @@
+import time
+
+import temporizador as t
+
+
+def test_jobs_etag_changes_with_the_time_slot(monkeypatch):
+    client = t.app.test_client()
+    job_id = client.post("/timer", json={"device_name": "etag", "action": "off", "minutes": 30}).get_json()["job_id"]
+    try:
+        monkeypatch.setattr(t, "JOBS_ETAG_INTERVAL", 10 ** 9)
+        first = client.get("/jobs")
+        again = client.get("/jobs", headers={"If-None-Match": first.headers["ETag"]})
+        assert again.status_code == 304
+
+        # En otra franja los tiempos restantes han cambiado: no vale el ETag anterior
+        monkeypatch.setattr(t, "JOBS_ETAG_INTERVAL", 0.001)
+        time.sleep(0.01)
+        later = client.get("/jobs", headers={"If-None-Match": first.headers["ETag"]})
+        assert later.status_code == 200
+        assert later.headers["ETag"] != first.headers["ETag"]
+        job = next(job for job in later.get_json()["jobs"] if job["id"] == job_id)
+        assert 0 < job["remaining_seconds"] <= 30 * 60
+    finally:
+        t.cancel_job_entry(job_id)
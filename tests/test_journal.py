@@ -0,0 +1,113 @@
+import json
+
+import temporizador as t
+
+
+def schedule_event(job_id, due=2000000000.0):
+    return {"e": "schedule", "id": job_id, "account": "test@example.com", "device": "KodiPlex",
+            "action": "off", "start": due - 60, "due": due}
+
+
+def open_journal(path, **kwargs):
+    journal = t.JobJournal(str(path), **kwargs)
+    journal.replay(compact=False)
+    journal.start()
+    return journal
+
+
+def read_lines(path):
+    return [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+
+
+def test_replay_returns_only_pending_jobs(tmp_path):
+    path = tmp_path / "jobs.journal"
+    journal = open_journal(path)
+    for job_id in ("a", "b", "c", 'con "comillas"'):
+        journal.append(schedule_event(job_id))
+    journal.append({"e": "complete", "id": "a", "status": "success"})
+    journal.append({"e": "cancel", "id": "b"})
+    journal.sync()
+
+    events = t.JobJournal(str(path)).replay(compact=False)
+    assert sorted(event["id"] for event in events) == ["c", 'con "comillas"']
+    assert events[0]["due"] == 2000000000.0
+
+
+def test_replay_ignores_torn_last_line(tmp_path):
+    path = tmp_path / "jobs.journal"
+    journal = open_journal(path)
+    journal.append(schedule_event("a"), wait=True)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"e":"schedule","id":"b","acc')
+
+    replayed = t.JobJournal(str(path))
+    assert [event["id"] for event in replayed.replay(compact=False)] == ["a"]
+    assert replayed.stats["replayed_entries"] == 1
+
+
+def test_rule_rewrites_keep_the_latest_line(tmp_path):
+    path = tmp_path / "jobs.journal"
+    journal = open_journal(path)
+    for last in (1, 2, 3):
+        journal.append({"e": "rule", "id": "r", "account": "test@example.com", "device": "KodiPlex",
+                        "action": "on", "cron": "0 9 * * *", "last": last})
+    journal.sync()
+
+    events = t.JobJournal(str(path)).replay(compact=False)
+    assert [(event["id"], event["last"]) for event in events] == [("r", 3)]
+
+
+def test_replay_with_compaction_rewrites_only_live_entries(tmp_path):
+    path = tmp_path / "jobs.journal"
+    journal = open_journal(path)
+    for i in range(10):
+        journal.append(schedule_event(f"job{i}"))
+    for i in range(8):
+        journal.append({"e": "complete", "id": f"job{i}", "status": "success"})
+    journal.sync()
+    assert len(read_lines(path)) == 18
+
+    events = t.JobJournal(str(path)).replay(compact=True)
+    assert sorted(event["id"] for event in events) == ["job8", "job9"]
+    assert sorted(line["id"] for line in read_lines(path)) == ["job8", "job9"]
+    assert not (tmp_path / "jobs.journal.tmp").exists()
+
+
+def test_leader_compacts_when_dead_entries_pile_up(tmp_path):
+    path = tmp_path / "jobs.journal"
+    journal = open_journal(path, compact_min=10)
+    journal.compaction_enabled = True
+    journal.append(schedule_event("keep"))
+    for i in range(20):
+        journal.append(schedule_event(f"done{i}"))
+        journal.append({"e": "complete", "id": f"done{i}", "status": "success"}, wait=True)
+    journal.append(schedule_event("last"), wait=True)
+
+    assert journal.stats["compactions"] >= 1
+    lines = read_lines(path)
+    assert len(lines) < 20
+    assert {event["id"] for event in t.JobJournal(str(path)).replay(compact=False)} == {"keep", "last"}
+
+
+def test_notices_neither_keep_nor_close_jobs(tmp_path):
+    path = tmp_path / "jobs.journal"
+    journal = open_journal(path)
+    journal.append(schedule_event("a"))
+    journal.append({"e": "status", "id": "a", "status": "executing", "deferred_until": None, "fields": {}})
+    journal.append({"e": "cancel_request", "id": "a"})
+    journal.append({"e": "status", "id": "b", "status": "preparing", "deferred_until": None, "fields": {}})
+    journal.sync()
+
+    assert [event["id"] for event in t.JobJournal(str(path)).replay(compact=False)] == ["a"]
+
+
+def test_follower_applies_status_changes(monkeypatch):
+    monkeypatch.setattr(t.scheduler_leadership, "is_leader", False)
+    t.apply_journal_events([schedule_event("seguido")])
+    try:
+        t.apply_journal_events([{"e": "status", "id": "seguido", "status": "executing",
+                                 "deferred_until": None, "fields": {"device": "KodiPlex"}}])
+        assert t.job_registry.get("seguido").status == "executing"
+        assert t.job_events.since(0)[0][-1]["type"] == "executing"
+    finally:
+        t.job_registry.remove("seguido")
@@ -0,0 +1,98 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import temporizador as t
+
+
+@pytest.mark.parametrize("field, expected", [
+    ("*", "*"),
+    ("0", "sun"),
+    ("7", "sun"),
+    ("1-5", "mon-fri"),
+    ("0,6", "sun,sat"),
+    ("sat,sun", "sat,sun"),
+    # Los pasos se expanden desde el domingo, como en cron
+    ("*/2", "sun,tue,thu,sat"),
+    ("1-5/2", "mon,wed,fri"),
+    ("0-6/3", "sun,wed,sat"),
+    # Rangos que pasan por el domingo
+    ("0-5", "sun,mon-fri"),
+    ("5-7", "sun,fri-sat"),
+    ("0-7", "sun,mon-sat"),
+])
+def test_crontab_weekdays(field, expected):
+    assert t.crontab_weekdays(field) == expected
+
+
+def next_fires(expression, after, count):
+    trigger = t.build_trigger(expression)
+    fires = []
+    for _ in range(count):
+        after = t.SPAIN_TZ.normalize(trigger.get_next_fire_time(None, after))
+        fires.append(after)
+        after += timedelta(seconds=1)
+    return fires
+
+
+@pytest.mark.parametrize("cron, weekdays", [
+    ("0 9 * * */2", {"Sun", "Tue", "Thu", "Sat"}),
+    ("30 1 * * 0-5", {"Sun", "Mon", "Tue", "Wed", "Thu", "Fri"}),
+    ("0 8 * * 1-5", {"Mon", "Tue", "Wed", "Thu", "Fri"}),
+])
+def test_cron_weekdays_fire_on_cron_days(cron, weekdays):
+    expression, error = t.build_cron_expression({"cron": cron})
+    assert error is None
+    start = t.SPAIN_TZ.localize(datetime(2030, 1, 7))
+    fires = next_fires(expression, start, 21)
+    assert {fire.strftime("%a") for fire in fires} == weekdays
+
+
+@pytest.mark.parametrize("cron", ["0 9 * * 8", "0 9 * * 5-1", "0 9 *", "0 9 1 * 1", "0 9 1-7 * mon"])
+def test_invalid_cron_is_rejected(cron):
+    expression, error = t.build_cron_expression({"cron": cron})
+    assert expression is None and error
+
+
+def test_day_of_month_alone_is_accepted():
+    expression, error = t.build_cron_expression({"cron": "0 9 1 * *"})
+    assert error is None
+    start = t.SPAIN_TZ.localize(datetime(2030, 1, 2))
+    assert [fire.day for fire in next_fires(expression, start, 3)] == [1, 1, 1]
+
+
+def last_sunday(year, month):
+    day = datetime(year, month + 1, 1) - timedelta(days=1)
+    return day - timedelta(days=(day.weekday() + 1) % 7)
+
+
+def test_daily_rule_keeps_local_time_across_dst():
+    expression, _ = t.build_cron_expression({"time": "09:00", "days": "daily"})
+    change = last_sunday(2030, 3)
+    fires = next_fires(expression, t.SPAIN_TZ.localize(change - timedelta(days=1)), 3)
+    assert [fire.strftime("%H:%M") for fire in fires] == ["09:00"] * 3
+    assert [fire.utcoffset() for fire in fires] == [timedelta(hours=1), timedelta(hours=2), timedelta(hours=2)]
+
+
+def test_skipped_hour_fires_once_after_spring_forward():
+    # El último domingo de marzo las 02:30 no existen en España
+    expression, _ = t.build_cron_expression({"time": "02:30"})
+    change = last_sunday(2030, 3)
+    fires = next_fires(expression, t.SPAIN_TZ.localize(change), 3)
+    assert [fire.date() for fire in fires] == [(change + timedelta(days=i)).date() for i in range(3)]
+    assert fires[0].strftime("%H:%M %z") == "03:30 +0200"
+
+
+def test_repeated_hour_fires_once_after_fall_back():
+    # El último domingo de octubre las 02:30 ocurren dos veces: solo se dispara una
+    expression, _ = t.build_cron_expression({"time": "02:30"})
+    change = last_sunday(2030, 10)
+    fires = next_fires(expression, t.SPAIN_TZ.localize(change), 3)
+    assert [fire.date() for fire in fires] == [(change + timedelta(days=i)).date() for i in range(3)]
+
+
+def test_rule_next_fire_follows_last_fire():
+    expression, _ = t.build_cron_expression({"time": "07:15", "days": "weekdays"})
+    friday = t.SPAIN_TZ.localize(datetime(2030, 1, 11, 7, 15))
+    rule = t.RecurringRule("rule", "test@example.com", "KodiPlex", "on", expression, friday.timestamp())
+    assert rule.next_fire() == t.SPAIN_TZ.localize(datetime(2030, 1, 14, 7, 15))